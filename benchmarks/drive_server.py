@@ -0,0 +1,295 @@
+"""
+Local stand-in for the Google Drive v3 endpoints used by KM Explorer
+
+Serves files/{id}?alt=media (with Range support), files/{id} metadata, files.list,
+batched files.get and changes.list, with configurable latency, a per-connection bandwidth cap, and 5xx/429 errors
+injected on a fixed schedule, so every run sees the same number of faults.
+"""
+import re
+import json
+import random
+import asyncio
+import hashlib
+from aiohttp import web
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+MODIFIED_TIME = "2024-01-01T00:00:00.000Z"
+SEND_CHUNK_SIZE = 2**16
+# File contents repeat a seeded block of this many bytes, so large files cost no memory. It isn't a power
+# of two, so a range written at a block-aligned wrong offset still fails the checksum.
+DATA_BLOCK_SIZE = 2**20 + 7
+FAULT_STATUSES = [500, 502, 503, 429]
+
+class FakeDriveServer:
+    # latency: seconds added before every response
+    # bandwidth: bytes per second per connection (None for unlimited)
+    # fault_every: every Nth request (and batch part) is answered with the next of FAULT_STATUSES (0 for none)
+    def __init__(self, latency=0, bandwidth=None, fault_every=0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fault_every = fault_every
+        self.num_fault_checks = 0
+        self.random = random.Random(seed)
+        self.files = {}
+        self.children = {}
+        self.blocks = {}
+        self.change_log = []
+        self.runner = None
+        self.port = None
+        self.num_requests = 0
+        self.num_faults = 0
+
+    #region Files
+
+    def AddFolder(self, folder_id, name, parent_id=None):
+        self.files[folder_id] = {'id': folder_id, 'name': name, 'mimeType': FOLDER_MIME_TYPE}
+        self.children.setdefault(folder_id, [])
+        if parent_id:
+            self.children.setdefault(parent_id, []).append(folder_id)
+        self.change_log.append(folder_id)
+        return folder_id
+
+    def AddFile(self, file_id, name, size, parent_id=None, mime_type="video/mp4"):
+        self.blocks[file_id] = self.random.randbytes(min(size, DATA_BLOCK_SIZE))
+        self.files[file_id] = {
+            'id': file_id,
+            'name': name,
+            'mimeType': mime_type,
+            'size': str(size),
+            'md5Checksum': self.GetChecksum(file_id, size),
+            'modifiedTime': MODIFIED_TIME
+        }
+        if parent_id:
+            self.children.setdefault(parent_id, []).append(file_id)
+        self.change_log.append(file_id)
+        return self.files[file_id]
+
+    def RenameFile(self, file_id, name):
+        self.files[file_id]['name'] = name
+        self.change_log.append(file_id)
+
+    def RemoveFile(self, file_id):
+        del self.files[file_id]
+        self.blocks.pop(file_id, None)
+        for children in self.children.values():
+            if file_id in children:
+                children.remove(file_id)
+        self.change_log.append(file_id)
+
+    def GetSize(self, file_id):
+        return int(self.files[file_id]['size'])
+
+    def GetBytes(self, file_id, start_byte, end_byte):
+        # Bytes start_byte to end_byte (exclusive) of the file, cut from its repeating block
+        block = self.blocks[file_id]
+        chunks = []
+        while start_byte < end_byte:
+            offset = start_byte % len(block)
+            chunk = block[offset:offset + end_byte - start_byte]
+            chunks.append(chunk)
+            start_byte += len(chunk)
+        return b''.join(chunks)
+
+    def GetChecksum(self, file_id, size):
+        md5 = hashlib.md5()
+        for start_byte in range(0, size, DATA_BLOCK_SIZE):
+            md5.update(self.GetBytes(file_id, start_byte, min(size, start_byte + DATA_BLOCK_SIZE)))
+        return md5.hexdigest()
+
+    def GetParents(self, file_id):
+        return [folder_id for folder_id, children in self.children.items() if file_id in children]
+
+    def AddTree(self, root_id, num_folders, files_per_folder, file_size):
+        # A root folder of num_folders subfolders, each holding files_per_folder files
+        self.AddFolder(root_id, root_id)
+        for folder in range(num_folders):
+            folder_id = self.AddFolder(f"{root_id}-{folder}", f"Folder {folder}", root_id)
+            for index in range(files_per_folder):
+                self.AddFile(f"{folder_id}-{index}", f"File {index}.bin", file_size, folder_id)
+
+    #endregion
+
+    #region Server
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/drive/v3/files"
+
+    @property
+    def batch_url(self):
+        return f"http://127.0.0.1:{self.port}/batch/drive/v3"
+
+    async def Start(self, port=0):
+        app = web.Application()
+        app.router.add_get("/drive/v3/files", self.HandleList)
+        app.router.add_get("/drive/v3/files/{file_id}", self.HandleGet)
+        app.router.add_get("/drive/v3/changes/startPageToken", self.HandleStartPageToken)
+        app.router.add_get("/drive/v3/changes", self.HandleChanges)
+        app.router.add_post("/batch/drive/v3", self.HandleBatch)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def Stop(self):
+        await self.runner.cleanup()
+
+    async def Delay(self):
+        self.num_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def IsFaultDue(self):
+        if not self.fault_every:
+            return False
+        self.num_fault_checks += 1
+        return self.num_fault_checks % self.fault_every == 0
+
+    def InjectFault(self):
+        if self.IsFaultDue():
+            status = FAULT_STATUSES[self.num_faults % len(FAULT_STATUSES)]
+            self.num_faults += 1
+            headers = {"Retry-After": "0"} if status == 429 else {}
+            return web.json_response({'error': {'code': status, 'message': "Injected fault"}}, status=status, headers=headers)
+        return None
+
+    #endregion
+
+    #region Handlers
+
+    async def HandleList(self, request : web.Request):
+        await self.Delay()
+        fault = self.InjectFault()
+        if fault:
+            return fault
+
+        match = re.search(r"'([^']+)' in parents", request.query.get('q', ''))
+        if not match or match.group(1) not in self.children:
+            return web.json_response({'error': {'code': 404, 'message': "Folder not found"}}, status=404)
+
+        page_size = int(request.query.get('pageSize', 100))
+        start = int(request.query.get('pageToken', 0))
+        ids = self.children[match.group(1)]
+        if request.query.get('orderBy'):
+            # Only the "folder,name_natural" order the app asks for
+            ids = sorted(ids, key=lambda file_id: (self.files[file_id]['mimeType'] != FOLDER_MIME_TYPE, [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", self.files[file_id]['name'].casefold())]))
+
+        page = {'files': [self.files[file_id] for file_id in ids[start:start + page_size]]}
+        if start + page_size < len(ids):
+            page['nextPageToken'] = str(start + page_size)
+        return web.json_response(page)
+
+    async def HandleGet(self, request : web.Request):
+        await self.Delay()
+        fault = self.InjectFault()
+        if fault:
+            return fault
+
+        file_id = request.match_info['file_id']
+        if file_id not in self.files:
+            return web.json_response({'error': {'code': 404, 'message': "File not found"}}, status=404)
+        if request.query.get('alt') != 'media':
+            return web.json_response(self.files[file_id])
+
+        size = self.GetSize(file_id)
+        start_byte, end_byte, status = 0, size, 200
+        headers = {"Content-Type": "application/octet-stream"}
+
+        range_header = request.headers.get("Range")
+        if range_header:
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header)
+            if not match or int(match.group(1)) >= size:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+            start_byte = int(match.group(1))
+            end_byte = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            status = 206
+            headers["Content-Range"] = f"bytes {start_byte}-{end_byte - 1}/{size}"
+
+        headers["Content-Length"] = str(end_byte - start_byte)
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        await self.Send(response, file_id, start_byte, end_byte)
+        return response
+
+    async def HandleStartPageToken(self, request : web.Request):
+        await self.Delay()
+        return web.json_response({'startPageToken': str(len(self.change_log))})
+
+    async def HandleChanges(self, request : web.Request):
+        # Page tokens are positions in change_log; every change reports the file as it is now
+        await self.Delay()
+        fault = self.InjectFault()
+        if fault:
+            return fault
+
+        start = int(request.query['pageToken'])
+        page_size = int(request.query.get('pageSize', 100))
+        changes = []
+        for file_id in self.change_log[start:start + page_size]:
+            if file_id in self.files:
+                changes.append({'changeType': 'file', 'fileId': file_id, 'removed': False, 'file': {**self.files[file_id], 'parents': self.GetParents(file_id), 'trashed': False}})
+            else:
+                changes.append({'changeType': 'file', 'fileId': file_id, 'removed': True})
+
+        page = {'changes': changes}
+        if start + page_size < len(self.change_log):
+            page['nextPageToken'] = str(start + page_size)
+        else:
+            page['newStartPageToken'] = str(len(self.change_log))
+        return web.json_response(page)
+
+    async def HandleBatch(self, request : web.Request):
+        # Answers each files.get part in a multipart/mixed batch; every part can fail on its own
+        await self.Delay()
+        fault = self.InjectFault()
+        if fault:
+            return fault
+
+        boundary = re.search(r"boundary=([^;]+)", request.headers.get("Content-Type", "")).group(1)
+        body = (await request.text()).replace('\r\n', '\n')
+
+        parts = []
+        for part in body.split(f"--{boundary}"):
+            match = re.search(r"Content-ID: <([^>]+)>\n\nGET [^\s?]*/files/([^\s?]+)", part)
+            if not match:
+                continue
+            content_id, file_id = match.groups()
+
+            if self.IsFaultDue():
+                self.num_faults += 1
+                status, payload = 503, {'error': {'code': 503, 'message': "Injected fault"}}
+            elif file_id in self.files:
+                status, payload = 200, self.files[file_id]
+            else:
+                status, payload = 404, {'error': {'code': 404, 'message': "File not found"}}
+
+            parts.append(
+                f"--batch_response\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+
+        return web.Response(
+            text=''.join(parts) + "--batch_response--\r\n",
+            headers={"Content-Type": "multipart/mixed; boundary=batch_response"}
+        )
+
+    async def Send(self, response : web.StreamResponse, file_id, start_byte, end_byte):
+        # Paces each connection to self.bandwidth, like Drive's per-connection throttling
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        sent = 0
+
+        for offset in range(start_byte, end_byte, SEND_CHUNK_SIZE):
+            chunk = self.GetBytes(file_id, offset, min(end_byte, offset + SEND_CHUNK_SIZE))
+            await response.write(chunk)
+            sent += len(chunk)
+            if self.bandwidth:
+                delay = start_time + sent / self.bandwidth - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+    #endregion
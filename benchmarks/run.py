@@ -0,0 +1,260 @@
+"""
+Download and listing benchmarks against a local Drive stand-in server
+
+    python benchmarks/run.py [--quick] [--json results.json]
+
+Every benchmark runs the real download engine; only the Drive endpoints are simulated.
+"""
+import os
+import sys
+import json
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from drive_server import FakeDriveServer
+
+MB = 2**20
+BENCHMARK_FOLDER = "benchmark-folder"
+BENCHMARK_TREE = "benchmark-tree"
+
+class ServerThread:
+    # Runs the stand-in server on its own event loop, so serving does not compete with the client loop
+    def __init__(self, server : FakeDriveServer, port):
+        self.server = server
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def Start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.Start(self.port), self.loop).result()
+
+    def Stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.Stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def GetFreePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class Benchmarks:
+    def __init__(self, server : FakeDriveServer, output=sys.stdout, fast_retries=True):
+        # Imported here, after KMEXPLORER_DRIVE_FILES_URL points at the stand-in server
+        from kmexplorer.drive import DriveSession, DriveToken, RetryPolicy
+        from kmexplorer.engine import DownloadEngine
+
+        self.server = server
+        self.output = output
+        self.drive_session = DriveSession()
+        self.token = DriveToken(access_token="benchmark")
+        retry_policy = RetryPolicy(base_delay=0.05, max_delay=0.5) if fast_retries else None
+        self.engine = DownloadEngine(self.drive_session, self.token, retry_policy=retry_policy, on_error=lambda title, message: print(f"{title}: {message}", file=sys.stderr))
+        self.results = []
+
+    def Record(self, benchmark, **result):
+        result = {'benchmark': benchmark, **result}
+        self.results.append(result)
+        print("  ".join(f"{key}={value}" for key, value in result.items()), file=self.output, flush=True)
+
+    async def DownloadFile(self, file_id, num_parts, adaptive):
+        from kmexplorer.engine import GetDriveFile
+        from kmexplorer.download import ProgressAggregator
+
+        file = GetDriveFile(self.server.files[file_id])
+        with tempfile.TemporaryDirectory() as folder:
+            progress = ProgressAggregator(file.size)
+            tracemalloc.start()
+            start_time = perf_counter()
+            success = await self.engine.DownloadFile(file, os.path.join(folder, file.name), progress, num_parts, adaptive=adaptive)
+            duration = perf_counter() - start_time
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        return success, duration, peak_memory
+
+    async def RunDownloads(self, sizes, part_counts, fault_every=0):
+        from kmexplorer.engine import NUM_DL_PARTS
+
+        self.server.fault_every = fault_every
+        for size in sizes:
+            file_id = f"file-{size}"
+            for num_parts in part_counts:
+                adaptive = num_parts == 'adaptive'
+                faults = self.server.num_faults
+                # Adaptive downloads still need a part count, or the file is fetched as one stream
+                success, duration, peak_memory = await self.DownloadFile(file_id, NUM_DL_PARTS if adaptive else num_parts, adaptive)
+                self.Record(
+                    "download_faults" if fault_every else "download",
+                    size_mb=size,
+                    parts=num_parts,
+                    success=success,
+                    seconds=round(duration, 3),
+                    mb_per_second=round(size / duration, 2),
+                    peak_memory_mb=round(peak_memory / MB, 2),
+                    faults=self.server.num_faults - faults
+                )
+        self.server.fault_every = 0
+
+    async def RunFolder(self, num_files, connections, num_parts):
+        from kmexplorer.download import ProgressAggregator
+        from kmexplorer.engine import FolderWalker, DownloadPathPlanner, GetDriveFile
+
+        with tempfile.TemporaryDirectory() as folder:
+            progress = ProgressAggregator(0)
+            scheduler = self.engine.CreateScheduler(progress, max_connections=connections, num_parts=num_parts)
+            paths = DownloadPathPlanner(folder)
+
+            def AddFiles(files, relative_dir):
+                for file in map(GetDriveFile, files):
+                    progress.AddTotal(file.size)
+                    scheduler.Add(file, paths.GetPath(relative_dir, file.name))
+
+            start_time = perf_counter()
+            scheduler.BeginAdding()
+            listing = asyncio.ensure_future(FolderWalker(self.drive_session, self.token).Walk(BENCHMARK_FOLDER, AddFiles))
+            listing.add_done_callback(lambda _: scheduler.FinishAdding())
+            success = await scheduler.Run() and await listing
+            duration = perf_counter() - start_time
+
+        self.Record(
+            "folder",
+            files=num_files,
+            connections=connections,
+            success=success,
+            seconds=round(duration, 3),
+            files_per_second=round(num_files / duration, 1),
+            mb_per_second=round(progress.total_bytes / MB / duration, 2)
+        )
+
+    async def RunListing(self, num_folders, files_per_folder, max_listings):
+        from kmexplorer.engine import FolderWalker
+
+        walker = FolderWalker(self.drive_session, self.token, max_listings=max_listings)
+        requests = self.server.num_requests
+        start_time = perf_counter()
+        success = await walker.Walk(BENCHMARK_TREE, lambda files, relative_dir: None)
+        duration = perf_counter() - start_time
+
+        self.Record(
+            "listing",
+            folders=num_folders,
+            files=walker.num_files,
+            max_listings=max_listings,
+            latency_ms=round(self.server.latency * 1000),
+            success=success,
+            seconds=round(duration, 3),
+            requests=self.server.num_requests - requests
+        )
+
+    async def RunMetadata(self, file_ids, batch_size):
+        from kmexplorer.client import DriveClient
+        from kmexplorer.metadata import DriveMetadata
+
+        metadata = DriveMetadata(DriveClient(self.drive_session, self.token), batch_size=batch_size)
+        requests = self.server.num_requests
+        start_time = perf_counter()
+        # Concurrent lookups, as the app makes them, coalesce into batch requests
+        results = await asyncio.gather(*map(metadata.Get, file_ids))
+        duration = perf_counter() - start_time
+
+        self.Record(
+            "metadata",
+            files=len(file_ids),
+            batch_size=batch_size,
+            latency_ms=round(self.server.latency * 1000),
+            success=len(results) == len(file_ids),
+            seconds=round(duration, 3),
+            requests=self.server.num_requests - requests
+        )
+
+    async def Close(self):
+        await self.drive_session.Close()
+
+async def RunBenchmarks(server, args, output):
+    benchmarks = Benchmarks(server, output)
+    try:
+        await benchmarks.RunDownloads(args.sizes, args.parts)
+        if args.fault_every:
+            await benchmarks.RunDownloads(args.sizes[-1:], args.parts[-1:], args.fault_every)
+        await benchmarks.RunFolder(args.files, args.connections, args.folder_parts)
+
+        # Listing is dominated by request latency, so it is measured with the configured latency
+        # even when downloads ran without it
+        server.latency = max(server.latency, args.list_latency / 1000)
+        for max_listings in [1, 8]:
+            await benchmarks.RunListing(args.folders, args.files_per_folder, max_listings)
+
+        # Metadata lookups for every file in the folder benchmark, one request each and then batched
+        file_ids = [f"small-{index}" for index in range(args.files)]
+        for batch_size in [1, 100]:
+            await benchmarks.RunMetadata(file_ids, batch_size)
+    finally:
+        await benchmarks.Close()
+    return benchmarks.results
+
+def CreateParser():
+    parser = argparse.ArgumentParser(description="Benchmark KM Explorer downloads and listing against a local Drive stand-in")
+    parser.add_argument('--quick', action='store_true', help="Small sizes for a fast smoke run")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 128], help="File sizes in MB")
+    parser.add_argument('--parts', nargs='+', default=['1', '4', '12', 'adaptive'], help="Part counts to compare, or 'adaptive'")
+    parser.add_argument('--bandwidth', type=float, default=8, help="Per-connection bandwidth cap in MB/s (0 for unlimited)")
+    parser.add_argument('--latency', type=float, default=20, help="Latency added to every response, in ms")
+    parser.add_argument('--list-latency', type=float, default=50, help="Latency for the listing benchmark, in ms")
+    parser.add_argument('--fault-every', type=int, default=3, help="Fail every Nth request with 5xx/429 in the fault benchmark (0 to skip it)")
+    parser.add_argument('--files', type=int, default=500, help="Number of small files in the folder benchmark")
+    parser.add_argument('--file-size', type=int, default=64, help="Size of each small file in KB")
+    parser.add_argument('--connections', type=int, default=12, help="Connections for the folder benchmark")
+    parser.add_argument('--folder-parts', type=int, default=12, help="Parts per file in the folder benchmark")
+    parser.add_argument('--folders', type=int, default=50, help="Folders in the listing benchmark")
+    parser.add_argument('--files-per-folder', type=int, default=300, help="Files per folder in the listing benchmark")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    return parser
+
+def main(argv=None):
+    args = CreateParser().parse_args(argv)
+    if args.quick:
+        args.sizes, args.files, args.folders, args.files_per_folder = [4, 32], 100, 10, 50
+    args.parts = [part if part == 'adaptive' else int(part) for part in args.parts]
+
+    server = FakeDriveServer(latency=args.latency / 1000, bandwidth=args.bandwidth * MB if args.bandwidth else None)
+    for size in args.sizes:
+        server.AddFile(f"file-{size}", f"file-{size}.bin", size * MB)
+
+    server.AddFolder(BENCHMARK_FOLDER, BENCHMARK_FOLDER)
+    for index in range(args.files):
+        server.AddFile(f"small-{index}", f"small-{index}.bin", args.file_size * 2**10, BENCHMARK_FOLDER)
+
+    # The listing tree only needs metadata, so its files are empty
+    server.AddTree(BENCHMARK_TREE, args.folders, args.files_per_folder, 0)
+
+    port = GetFreePort()
+    os.environ["KMEXPLORER_DRIVE_FILES_URL"] = f"http://127.0.0.1:{port}/drive/v3/files"
+    os.environ["KMEXPLORER_DRIVE_BATCH_URL"] = f"http://127.0.0.1:{port}/batch/drive/v3"
+
+    server_thread = ServerThread(server, port)
+    server_thread.Start()
+    output = sys.stdout
+    try:
+        # The engine's debug prints go to stderr, leaving stdout for the results
+        with redirect_stdout(sys.stderr):
+            results = asyncio.run(RunBenchmarks(server, args, output))
+    finally:
+        server_thread.Stop()
+
+    if args.json:
+        with open(args.json, "w", encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
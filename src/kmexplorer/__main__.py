@@ -1,4 +1,9 @@
-from kmexplorer.app import main
+import sys
 
 if __name__ == '__main__':
-    main().main_loop()
+    if len(sys.argv) > 1 and sys.argv[1] == 'download':
+        from kmexplorer.cli import main
+        sys.exit(main(sys.argv[1:]))
+    else:
+        from kmexplorer.app import main
+        main().main_loop()
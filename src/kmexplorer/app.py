@@ -2,7 +2,6 @@
 Play media from local, network, and Google Drive folders
 """
 import os
-import aiofiles
 
 TESTING = True
 START_PATH = ['app','src'][TESTING]
@@ -14,19 +13,28 @@ os.environ['PYTHON_VLC_MODULE_PATH'] = f"{CWD}\\{START_PATH}\\kmexplorer\\vlc-3.
 
 import vlc
 import math
-from functools import reduce
 from time import sleep
-import aiohttp
 import asyncio
 import requests
 import webbrowser
 from pydrive2.auth import GoogleAuth
-from pydrive2.drive import GoogleDrive
 from enum import Enum
 import toga
 from toga.style import Pack
 from toga.style.pack import COLUMN, ROW, CENTER, RIGHT, LEFT, HIDDEN, VISIBLE, TOP, BOTTOM
 from toga_winforms.libs.winforms import WinForms, Color, Size
+from kmexplorer.download import DownloadScheduler, DownloadOrder, ProgressAggregator, PROGRESS_SCALE, USER_CACHE_DIR
+from kmexplorer.drive import DriveSession, DriveToken
+from kmexplorer.client import DriveClient
+from kmexplorer.engine import DownloadEngine, FolderWalker, DownloadPathPlanner, GetDriveFile, NUM_DL_PARTS, ADAPTIVE_DOWNLOADS, MAX_DL_CONNECTIONS
+from kmexplorer.stream import StreamProxy
+from kmexplorer.cache import MediaCache, MEDIA_CACHE_SIZE
+from kmexplorer.sync import FolderSync
+from kmexplorer.telemetry import Telemetry, TelemetryFormat
+from kmexplorer.limiter import BandwidthLimiter
+from kmexplorer.metadata import DriveMetadata
+from kmexplorer.listing import FolderListingCache
+from kmexplorer.local import LocalEntry, ListLocalFolder
 
 #region Setup
 
@@ -38,19 +46,44 @@ GoogleAuth.DEFAULT_SETTINGS['client_config_file'] = CLIENT_SECRETS_PATH
 
 CREDENTIALS_PATH = f"{RESOURCES}\\user_creds.json"
 
+# Played media can take up to MEDIA_CACHE_SIZE, so it is kept in the user's cache directory rather than with the app
+MEDIA_CACHE_PATH = os.path.join(USER_CACHE_DIR, "media")
+TELEMETRY_PATH = f"{RESOURCES}\\telemetry"
+LISTING_CACHE_PATH = f"{RESOURCES}\\drive_listings.json"
+
 with open(f"{RESOURCES}\\API_KEY.txt", "r", encoding='utf-8') as f:
     API_KEY = f.readline()
 
-MIN_CHUNK_SIZE = 2**18
-NUM_DL_PARTS = 12
-INT32_MAX = 2147483647
-ADJUSTED_PROGRESS_DIVIDER = 10
+FOLDER_DOWNLOAD_ORDER = DownloadOrder.SMALLEST_FIRST
+# Download subfolders too, recreating the folder structure in the download folder
+RECURSIVE_FOLDER_DOWNLOADS = True
+# Only transfer new or changed files when downloading into a folder again,
+# optionally deleting local copies of files that were removed from Drive
+SYNC_FOLDER_DOWNLOADS = True
+DELETE_REMOVED_FILES = False
+# Start playing Drive media as soon as its first and last blocks are downloaded
+PROGRESSIVE_PLAYBACK = True
+# Streamed Drive media is also downloaded into the media cache, so playing it again is local
+STREAM_TO_MEDIA_CACHE = True
+# Fetch the first blocks (and MP4/MKV index) of highlighted Drive media before it is opened
+SPECULATIVE_PREFETCH = True
+
+# Shared by downloads and streaming, in MB/s (None for unlimited). Scheduled windows take precedence,
+# e.g. [limiter.BandwidthWindow("09:00", "17:00", 2)] keeps bulk downloads to 2 MB/s during work hours
+BANDWIDTH_LIMIT = None
+BANDWIDTH_SCHEDULE = []
+
+# With TELEMETRY_ENABLED, per-transfer metrics are appended to TELEMETRY_PATH after every download and folder job
+TELEMETRY_ENABLED = False
+TELEMETRY_FORMAT = TelemetryFormat.JSONL
 
 FOLDER_REPO = "Folder Repo"
 VLC_PLAYER =  "VLC Player"
 GET_FOLDER = "Enter Folder Name"
 RENAME_FOLDER = "Rename Folder"
+SET_BANDWIDTH_LIMIT = "Set Bandwidth Limit"
 PROGRESS_WINDOW = "Download Progress"
+DOWNLOAD_QUEUE_WINDOW = "Download Queue"
 PLAY_PAUSE = '⏯'
 PLAY = '⏵︎'
 PAUSE = '⏸︎'
@@ -65,6 +98,13 @@ HANDLED = "Handled"
 
 TIMEOUT_TIME = 2
 
+LOCAL_HEADINGS = ["Name", "Size", "Modified", "Type", "Path"]
+COLUMN_WIDTHS = {
+    "Size": 80,
+    "Modified": 120,
+    "Type": 100
+}
+
 _ESCAPE = WinForms.Keys.Escape
 _SPACE = WinForms.Keys.Space
 _DELETE = WinForms.Keys.Delete
@@ -150,32 +190,6 @@ class FolderType(Enum):
     GOOGLE_DRIVE = 2
     FOLDER_REPO = 3
 
-class File:
-    def __init__(self, id, name, size=None):
-        self.id = id
-        self.name = name
-        self.size = int(size)
-        self.chunk_size = self.size // 100
-        
-    def GetSizeMB(self):
-        return round(self.size / 2**20, 2)
-    
-    def CreatePartitions(self, num_parts):
-        part_size = self.size // num_parts
-        remainder = self.size - (part_size * num_parts)
-
-        part_size_list = [int(part_size)] * num_parts
-        part_size_list[0] += remainder
-
-        start_byte = 0
-        partitions = []
-        
-        for _part_size in part_size_list:
-            partitions.append((start_byte, _part_size + start_byte))
-            start_byte += _part_size
-        
-        return partitions
-            
 #endregion
 
 #region Startup
@@ -183,8 +197,21 @@ class File:
 class KMExplorer(toga.App):
     def startup(self):
         self.google_authenticated = False
-        self.drive = GoogleDrive()
+        self.drive_token = None
         self.google_folder_id = ''
+        self.google_folder_name = None
+        self.drive_session = DriveSession()
+        self.bandwidth_limiter = BandwidthLimiter(BANDWIDTH_LIMIT, BANDWIDTH_SCHEDULE)
+        self.stream_proxy = StreamProxy(api_key=API_KEY, limiter=self.bandwidth_limiter)
+        self.media_cache = MediaCache(MEDIA_CACHE_PATH, MEDIA_CACHE_SIZE)
+        self.stream_cache_download = None
+        # Lookups, listings and downloads share the UI loop and one connection pool
+        self.drive_client = DriveClient(self.drive_session)
+        self.drive_metadata = DriveMetadata(self.drive_client)
+        self.folder_listings = FolderListingCache(LISTING_CACHE_PATH, self.drive_client)
+        self.telemetry = Telemetry(TELEMETRY_PATH, TELEMETRY_FORMAT) if TELEMETRY_ENABLED else None
+        self.download_engine = DownloadEngine(self.drive_session, api_key=API_KEY, on_error=self.ShowDownloadError, telemetry=self.telemetry, limiter=self.bandwidth_limiter)
+        self.on_exit = self.OnExit
         self.mouse_hidden = False
         self.mouse_counter = 0
         
@@ -283,6 +310,13 @@ class KMExplorer(toga.App):
             group=file_group,
             section=1
         )
+        
+        set_bandwidth_limit = toga.Command(
+            self.ShowBandwidthLimitPrompt,
+            label=SET_BANDWIDTH_LIMIT,
+            group=file_group,
+            section=1
+        )
 
             #endregion
         
@@ -308,6 +342,7 @@ class KMExplorer(toga.App):
             import_folder_repo, 
             google_authenticate, 
             download_gdrive_folder, 
+            set_bandwidth_limit,
             save_folder_to_repo, 
             load_folder_repo,
             check_latest
@@ -345,6 +380,7 @@ class KMExplorer(toga.App):
         self.InitFolderTable()
         self.InitTextEntryWindow()
         self.InitDownloadProgressBarWindow()
+        self.InitDownloadQueueWindow()
         self.InitVLCWindow()
 
         #region Supporting Methods
@@ -366,6 +402,18 @@ class KMExplorer(toga.App):
             self.OnClickGetFolderContents()
             event.Handled = True
             
+    def OnExit(self, app, *args, **kwargs):
+        self.stream_proxy.Stop()
+        if self.drive_session.IsOpen():
+            print("DEBUG: Closing Drive Connection Pool Before Exiting")
+            self.add_background_task(self.CloseDriveSessionAndExit)
+            return False
+        return True
+    
+    async def CloseDriveSessionAndExit(self, widget, **kwargs):
+        await self.drive_session.Close()
+        self.exit()
+            
     def CheckLatestVersion(self, widget=''):
         try:
             latest = f"{self.home_page}/releases/latest"
@@ -833,6 +881,7 @@ class KMExplorer(toga.App):
     def StopVLC(self, widget='', hide=True):
         print(f"DEBUG: Stopping VLC Playback, Exiting Fullscreen{', And Hiding Window'*hide}")
         self.player.stop()
+        self.CancelStreamCache()
         self.vlc_window.title = VLC_PLAYER
         if hide:
             self.exit_full_screen()
@@ -921,11 +970,9 @@ class KMExplorer(toga.App):
         
     def PlayWithVLC(self, input_str, filename):
         print(f"DEBUG: Playing {input_str} With VLC")
+        if self.stream_cache_download and input_str != self.GetGoogleDriveURL(self.stream_cache_download.file.id):
+            self.CancelStreamCache()
         media = self.VLC_instance.media_new(input_str)
-        if self.folder_type == FolderType.GOOGLE_DRIVE:
-            http_token = f"http-token=\'Authorization: Bearer {self.gauth_token}\'"
-            print(http_token)
-            media.add_option(http_token)
         self.player.set_media(media)
         self.player.play()
         
@@ -948,7 +995,11 @@ class KMExplorer(toga.App):
                         file = lambda: None
                         file.id = input_str.split('/')[-1].split('?')[0]
                         file.name = filename
-                        self.DownloadFileAndPlayInVLC(file)
+                        
+                        async def DownloadFailedStream(widget, **kwargs):
+                            await self.DownloadFileAndPlayInVLC(file)
+                        
+                        self.add_background_task(DownloadFailedStream)
                 else:       
                     self.vlc_window.error_dialog(
                         "Unable To Play",
@@ -983,9 +1034,6 @@ class KMExplorer(toga.App):
 
     #region Get Folder Type
         
-    def SetFolderType(self, folder_str):
-        self.folder_type = self.GetFolderType(folder_str)
-        
     def GetFolderType(self, folder_str):
         if self.IsGoogleDriveFolder(folder_str):
             return FolderType.GOOGLE_DRIVE    
@@ -1023,44 +1071,59 @@ class KMExplorer(toga.App):
         return folder_str
     
     def SetFolderTableLocal(self, folder_str, from_folder_repo=False):
-        self.folder_type = FolderType.LOCAL_OR_NETWORK
+        folder_path = str(folder_str).replace('/', '\\').rstrip('\\')
+        folder_str = folder_path + '\\'
         
-        self.google_folder_id = ''
-        
-        folder_str = str(folder_str).replace('/', '\\').rstrip('\\')
-        self.local_folder_path = folder_str
-        folder_str += '\\'
-        local_files = os.listdir(folder_str)
-        local_data = [['..', self.GetOneFolderUpLocal(folder_str)]] + [*map(lambda file: [file, folder_str + file], local_files)]
-        
-        if from_folder_repo:
-            local_data = [['...', FOLDER_REPO]] + local_data
+        async def ShowLocalFolder(generation):
+            # One directory read gives every row its type, size and modified time. It runs on a worker
+            # thread, so a slow network share never blocks the window.
+            try:
+                local_entries = await asyncio.get_running_loop().run_in_executor(None, ListLocalFolder, folder_str, self.IsPlayableWithVLC)
+            except OSError as err:
+                if self.IsCurrentNavigation(generation):
+                    print(f"DEBUG: ERROR WHILE LISTING LOCAL FOLDER\n\n{err!r}\n\n")
+                    self.main_window.error_dialog(
+                        title="Unable to Open Folder",
+                        message=f"Unfortunately \"{folder_path}\" could not be opened. Please check the folder location and try again."
+                    )
+                return
+            
+            if not self.IsCurrentNavigation(generation):
+                return
+            
+            self.folder_type = FolderType.LOCAL_OR_NETWORK
+            self.google_folder_id = ''
+            self.google_folder_name = None
+            self.local_folder_path = folder_path
+            
+            local_entries = [LocalEntry('..', self.GetOneFolderUpLocal(folder_str), True)] + local_entries
+            if from_folder_repo:
+                local_entries = [LocalEntry('...', FOLDER_REPO, True)] + local_entries
+            
+            self.SetFolderTableFromData([entry.GetRow() for entry in local_entries], self.OnDoubleClickLocalFile, LOCAL_HEADINGS)
         
-        self.SetFolderTableFromData(local_data, self.OnDoubleClickLocalFile, ["Name", "Path"])
+        self.StartNavigation(ShowLocalFolder, folder_path)
         
-    def OpenLocalFile(self, file_path):
-        file_path = str(file_path)
+    def OpenLocalFile(self, file):
+        file_path = str(file.path)
         print(f"DEBUG: Local File Path = \"{file_path}\"")
         
-        if os.path.isdir(file_path):
+        if file.is_dir:
             self.folder_input.value = file_path
             self.SetFolderTable(file_path)
+        elif file.playable:
+            self.PlayWithVLC(file_path, file.name)
         else:
-            filename = file_path.split('\\')[-1]
-            
-            if self.IsPlayableWithVLC(filename):
-                self.PlayWithVLC(file_path, filename)
-            else:
-                print(f"DEBUG: Opening {filename} with default app")
-                os.startfile(file_path)
+            print(f"DEBUG: Opening {file.name} with default app")
+            os.startfile(file_path)
         
     def OnDoubleClickLocalFile(self, *args, **kwargs):
-        file_path = kwargs["row"].path
+        file = kwargs["row"]
         
-        if file_path == FOLDER_REPO:
+        if file.path == FOLDER_REPO:
             self.SetFolderTableFolderRepo()
         else:
-            self.OpenLocalFile(file_path)
+            self.OpenLocalFile(file)
         
     #endregion
 
@@ -1073,24 +1136,75 @@ class KMExplorer(toga.App):
         return  folder_url.split('/')[-1].replace('?usp=share_link','')
     
     def SetFolderTableGoogleDrive(self, folder_url="", folder_id="", from_folder_repo=False):
-        self.folder_type = FolderType.GOOGLE_DRIVE
-        
         if not from_folder_repo:
             folder_id = self.GetGoogleDriveFolderID(folder_url)
             
-        if (not self.google_authenticated) or self.gauth.access_token_expired or self.gauth.credentials is None:
+        if not self.google_authenticated:
             if not self.GoogleAuthenticate():
                 return
         
-        file_list = self.drive.ListFile({'q': f"'{folder_id}' in parents and trashed=false"}).GetList()
-        file_data = [*map(lambda file: [file['title'], file['id']], file_list)]
+        async def ShowGoogleDriveFolder(generation):
+            # The table only switches to this folder with the first page of its listing, so a navigation
+            # that is cancelled or fails before then leaves the previous folder showing as it was.
+            # The name is kept with the folder, so it doesn't depend on the metadata cache later on.
+            shown = False
+            folder_name = metadata['name'] if metadata else None
+            
+            def ShowPage(page):
+                nonlocal shown
+                if not self.IsCurrentNavigation(generation):
+                    return
+                if not shown:
+                    shown = True
+                    self.folder_type = FolderType.GOOGLE_DRIVE
+                    self.google_folder_id = folder_id
+                    self.google_folder_name = folder_name
+                    
+                    file_data = [['..', FOLDER_REPO]] if from_folder_repo else []
+                    self.SetFolderTableFromGoogleDriveData(file_data, self.OnDoubleClickGoogleDriveFile)
+                self.AddGoogleDriveRows(generation, page)
+            
+            async def GetFolderName():
+                nonlocal folder_name
+                folder_name = (await self.drive_metadata.Get(folder_id))['name']
+                if shown and self.IsCurrentNavigation(generation):
+                    self.google_folder_name = folder_name
+            
+            # Rows are added a page at a time as the listing arrives, while the folder name is looked up alongside it
+            try:
+                await asyncio.gather(
+                    self.ListGoogleDriveFolder(folder_id, on_page=ShowPage),
+                    GetFolderName()
+                )
+                # An empty folder has no pages
+                ShowPage([])
+            except Exception as err:
+                if self.IsCurrentNavigation(generation):
+                    print(f"DEBUG: ERROR WHILE LISTING GOOGLE DRIVE FOLDER\n\n{err!r}\n\n")
+                    self.main_window.error_dialog(
+                        title="Unable to List Google Drive Folder",
+                        message="Unfortunately the contents of this Google Drive folder could not be listed. Please try again later."
+                    )
         
-        self.google_folder_id = folder_id
+        metadata = self.drive_metadata.GetCached(folder_id)
+        self.StartNavigation(ShowGoogleDriveFolder, metadata['name'] if metadata else "Google Drive Folder")
         
-        if from_folder_repo:
-            file_data = [['..', FOLDER_REPO]] + file_data
+    async def ListGoogleDriveFolder(self, folder_id, on_page=None):
+        # Cached listings stay current through Drive's changes feed, and prime the metadata cache
+        def OnPage(page):
+            for metadata in page:
+                self.drive_metadata.Add(metadata)
+            if on_page:
+                on_page(page)
         
-        self.SetFolderTableFromGoogleDriveData(file_data, self.OnDoubleClickGoogleDriveFile)
+        return await self.folder_listings.List(folder_id, on_page=OnPage)
+    
+    def AddGoogleDriveRows(self, generation, page):
+        # Pages for a folder the user has already left are dropped
+        if not self.IsCurrentNavigation(generation):
+            return
+        for file in page:
+            self.folder_table.data.append(file['name'], file['id'])
         
     def OnDoubleClickGoogleDriveFile(self, *args, **kwargs):
         file = kwargs["row"]
@@ -1100,25 +1214,94 @@ class KMExplorer(toga.App):
         else:
             self.OpenGoogleDriveFile(file)
         
+    def OnSelectGoogleDriveFile(self, file):
+        # Fetches the start (and MP4/MKV index) of highlighted media while the user decides what to do with it,
+        # unless it is empty or the media cache would play it. Listings prime the metadata cache, so checking costs no request.
+        if not SPECULATIVE_PREFETCH or file.id == FOLDER_REPO or not self.IsPlayableWithVLC(file.name):
+            return
+        metadata = self.drive_metadata.GetCached(file.id)
+        if metadata:
+            drive_file = GetDriveFile(metadata)
+            if drive_file.size == 0 or self.media_cache.Contains(drive_file):
+                return
+        self.stream_proxy.Speculate(file.id, file.name)
+        
     def OpenGoogleDriveFile(self, file):
         print(f"DEBUG: Google Drive File ID = \"{file.id}\"")
         
         download_file = self.main_window.question_dialog(
             title="Google Drive Download File",
-            message=f"Would you like to download \"{file.name}\"?\n\nClick \"No\" to just play the file without downloading."
+            message=f"Would you like to download \"{file.name}\"?\n\nClick \"No\" to stream it instead. While it plays, it is also saved to the media cache so it can be played again without streaming; this stops when playback stops."
         ).future.result()
         
-        if download_file:
-            self.DownloadFileAndPlayInVLC(file)
-        else:
-            self.PlayGoogleDriveFileInVLC(file)
+        async def OpenFile(widget, **kwargs):
+            try:
+                if download_file:
+                    await self.DownloadFileAndPlayInVLC(file)
+                else:
+                    await self.PlayGoogleDriveFileInVLC(file)
+            except Exception as err:
+                print(f"DEBUG: ERROR WHILE OPENING GOOGLE DRIVE FILE\n\n{err!r}\n\n")
+                self.main_window.error_dialog(
+                    title="Unable to Open Google Drive File",
+                    message=f"Unfortunately \"{file.name}\" could not be found on Google Drive. Please try again later."
+                )
+        
+        self.add_background_task(OpenFile)
         
-    def PlayGoogleDriveFileInVLC(self, file):
+    async def PlayGoogleDriveFileInVLC(self, file):
+        drive_file = await self.GetGoogleDriveFile(file)
+        cached_path = self.media_cache.Lookup(drive_file)
+        if cached_path:
+            self.PlayWithVLC(cached_path, file.name)
+            return
+        
+        self.CacheStreamedFile(drive_file)
         url = self.GetGoogleDriveURL(file.id)
         self.PlayWithVLC(url, file.name)
     
+    def CacheStreamedFile(self, file):
+        # The proxy serves the file from its media cache copy as it fills in, and the copy is committed once verified.
+        # Only the file that is playing is filled; the one before it is cancelled and its partial copy removed once it stops.
+        if not STREAM_TO_MEDIA_CACHE or not self.IsPlayableWithVLC(file.name):
+            return
+        
+        self.CancelStreamCache()
+        
+        cache_path = self.media_cache.Reserve(file)
+        if cache_path is None:
+            return
+        self.media_cache.RemovePartial(keep=cache_path)
+        
+        print(f"DEBUG: Filling the media cache while streaming \"{file.name}\"")
+        loop = asyncio.get_running_loop()
+        download, result = self.stream_proxy.StartProgressive(file, cache_path)
+        self.stream_cache_download = download
+        result.add_done_callback(lambda future: loop.call_soon_threadsafe(self.OnStreamCached, file, download, future))
+    
+    def CancelStreamCache(self):
+        # Stopping playback (or playing something else) stops the fill; its partial copy is removed once it has stopped
+        if self.stream_cache_download:
+            print(f"DEBUG: Cancelling the media cache fill of \"{self.stream_cache_download.file.name}\"")
+            self.stream_proxy.CancelProgressive(self.stream_cache_download)
+            self.stream_cache_download = None
+    
+    def OnStreamCached(self, file, download, future):
+        if self.stream_cache_download is download:
+            self.stream_cache_download = None
+        if not future.cancelled() and future.exception() is None and future.result():
+            print(f"DEBUG: Added streamed \"{file.name}\" to the media cache")
+            self.media_cache.Commit(file)
+        else:
+            self.media_cache.RemovePartial(keep=self.stream_cache_download.download_path if self.stream_cache_download else None)
+        
+    async def GetGoogleDriveFile(self, _file):
+        # Served from the metadata cache when possible; otherwise batched with any other pending lookups
+        return GetDriveFile(await self.drive_metadata.Get(_file.id))
+    
     def GetGoogleDriveURL(self, file_id):
-        return f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media&key={API_KEY}"
+        # VLC plays Drive files through the local streaming proxy, which handles ranges and the access token
+        return self.stream_proxy.GetURL(file_id)
       
     #endregion
     
@@ -1135,65 +1318,65 @@ class KMExplorer(toga.App):
             return self.GoogleAuthenticate()
         
     def GoogleAuthenticate(self):
-        expired = False
-        error = False
         self.gauth = GoogleAuth()
         
         try:
             self.gauth.LoadCredentialsFile(CREDENTIALS_PATH)
         except Exception as err:
             print(err)
-
-        if self.gauth.access_token_expired:
-            try:
-                self.gauth.Refresh()
-            except Exception as err:
-                print(err)
-                expired = True
-                
-        if self.gauth.credentials is None or expired:
-            self.main_window.info_dialog(
-                title="Google Authentication",
-                message="Please sign in to your Google Account."
-            )
-            try:
-                self.gauth.LocalWebserverAuth()
-            except Exception as err:
-                print(err)
-                error = True             
-        else:
-            try:
-                self.gauth.Authorize()
-            except Exception as err:
-                print(err)
-                error = True 
         
-        if not error:
-            try:
-                self.gauth.SaveCredentialsFile(CREDENTIALS_PATH)
-            except Exception as err:
-                print(err)
-                error = True
+        if self.gauth.credentials is None and not self.GoogleSignIn():
+            return False
+        
+        self.SetDriveToken()
+        
+        if self.gauth.access_token_expired:
+            # Refreshed off the UI thread; Drive requests made in the meantime wait for the same refresh
+            self.add_background_task(self.RefreshGoogleToken)
         
-        if error:
+        return True
+    
+    def GoogleSignIn(self):
+        self.main_window.info_dialog(
+            title="Google Authentication",
+            message="Please sign in to your Google Account."
+        )
+        try:
+            self.gauth.LocalWebserverAuth()
+            self.gauth.SaveCredentialsFile(CREDENTIALS_PATH)
+        except Exception as err:
+            print(err)
             self.google_authenticated = False
             self.main_window.error_dialog(
                 title="Google Authentication Failed",
                 message="Google authentication failed. Please try again later."
             )
             return False
+        return True
+    
+    def SetDriveToken(self):
+        # One token for the whole session, since in-flight downloads and the streaming proxy hold on to it
+        if self.drive_token is None:
+            self.drive_token = DriveToken(self.gauth, CREDENTIALS_PATH)
+            self.download_engine.token = self.drive_token
+            self.stream_proxy.token = self.drive_token
+            self.drive_client.token = self.drive_token
+        else:
+            self.drive_token.SetCredentials(self.gauth)
         
-        self.gauth_token = self.gauth.credentials.access_token
-        
-        self.drive = GoogleDrive(self.gauth)
         self.google_authenticated = True
-        
-        return True
+    
+    async def RefreshGoogleToken(self, widget, **kwargs):
+        if await self.drive_token.Refresh(self.drive_token.Get()):
+            return
+        # The saved sign-in was revoked or has expired, so the user has to sign in again
+        if self.GoogleSignIn():
+            self.SetDriveToken()
     
     def GoogleReAuthenticate(self, *args, **kwargs):
         if args[1]:
             self.GoogleAuthenticate()
-        
+    
     #endregion
     
     #region Folder Repo
@@ -1408,8 +1591,10 @@ class KMExplorer(toga.App):
         #region Set Folder Table
         
     def SetFolderTableFolderRepo(self):
+        self.CancelNavigation()
         self.folder_type = FolderType.FOLDER_REPO
         self.google_folder_id = ''
+        self.google_folder_name = None
         
         self.SetFolderTableFromData(self.folder_repo, self.SetFolderTableFromFolderRepo, ['Name', 'Location'])
         
@@ -1457,9 +1642,14 @@ class KMExplorer(toga.App):
             style=Pack(padding=(5,0))
         )
         
+        self.download_stats_label = toga.Label(
+            text="",
+            style=Pack(padding=(5,0))
+        )
+        
         self.progress_bar = toga.ProgressBar(
             value=0,
-            max=100
+            max=PROGRESS_SCALE
         )
         
         self.progress_box = toga.Box(
@@ -1471,14 +1661,134 @@ class KMExplorer(toga.App):
         
         self.progress_box.add(self.download_progress_label)
         self.progress_box.add(self.progress_bar)
+        self.progress_box.add(self.download_stats_label)
         
-        self.progress_window = toga.Window(title=PROGRESS_WINDOW, closeable=False, size=(500,55))
+        self.progress_window = toga.Window(title=PROGRESS_WINDOW, closeable=False, size=(500,80))
         
         self.windows.add(self.progress_window)
         self.progress_window.content = self.progress_box
         
         self.progress_window.hide()
     
+    def StartDownloadProgress(self, total_bytes):
+        self.download_progress = ProgressAggregator(total_bytes)
+        self.download_stats_label.text = ""
+        self.progress_bar.max = PROGRESS_SCALE
+        self.progress_bar.value = 0
+        
+        self.progress_window.show()
+        self.progress_bar.start()
+        
+        self.download_progress_task = asyncio.ensure_future(self.download_progress.Run(self.UpdateDownloadProgress))
+        return self.download_progress
+    
+    def UpdateDownloadProgress(self, progress : ProgressAggregator):
+        self.progress_bar.value = progress.GetScaledValue()
+        self.download_stats_label.text = progress.FormatStatus()
+    
+    def ShowDownloadError(self, title, message):
+        self.main_window.error_dialog(
+            title=title,
+            message=message
+        )
+    
+    async def StopDownloadProgress(self):
+        self.download_progress.Stop()
+        await self.download_progress_task
+        
+        self.progress_bar.stop()
+        self.progress_window.hide()
+    
+        #endregion
+    
+        #region Download Queue Window
+    
+    def InitDownloadQueueWindow(self, widget=''):
+        self.download_scheduler = None
+        
+        self.download_queue_table = toga.Table(
+            headings=["Name", "Size", "Status"],
+            data=[],
+            style=Pack(
+                flex=1,
+                padding=5
+            )
+        )
+        
+        pause_button = toga.Button(
+            text="Pause",
+            on_press=self.PauseDownloadQueueItem,
+            style=Pack(padding=5)
+        )
+        
+        resume_button = toga.Button(
+            text="Resume",
+            on_press=self.ResumeDownloadQueueItem,
+            style=Pack(padding=5)
+        )
+        
+        cancel_button = toga.Button(
+            text="Cancel",
+            on_press=self.CancelDownloadQueueItem,
+            style=Pack(padding=5)
+        )
+        
+        button_box = toga.Box(style=Pack(direction=ROW, alignment=CENTER))
+        button_box.add(pause_button)
+        button_box.add(resume_button)
+        button_box.add(cancel_button)
+        
+        queue_box = toga.Box(
+            style=Pack(
+                direction=COLUMN,
+                padding=5
+            )
+        )
+        
+        queue_box.add(self.download_queue_table)
+        queue_box.add(button_box)
+        
+        self.download_queue_window = toga.Window(title=DOWNLOAD_QUEUE_WINDOW, closeable=False, size=(600,300))
+        
+        self.windows.add(self.download_queue_window)
+        self.download_queue_window.content = queue_box
+        
+        self.download_queue_window.hide()
+        
+    def RefreshDownloadQueue(self, scheduler : DownloadScheduler):
+        rows = self.download_queue_table.data
+        
+        if len(rows) != len(scheduler.items):
+            self.download_queue_table.data = [[item.file.name, f"{item.file.GetSizeMB():0.1f} MB", item.state.value] for item in scheduler.items]
+        else:
+            for row, item in zip(rows, scheduler.items):
+                if row.status != item.state.value:
+                    row.status = item.state.value
+    
+    def GetSelectedDownloadItem(self):
+        selection = self.download_queue_table.selection
+        if selection and self.download_scheduler:
+            return self.download_scheduler.items[self.download_queue_table.data.index(selection)]
+        return None
+    
+    def PauseDownloadQueueItem(self, widget=''):
+        item = self.GetSelectedDownloadItem()
+        if item:
+            print(f"DEBUG: Pausing Download Of \"{item.file.name}\"")
+            self.download_scheduler.Pause(item)
+    
+    def ResumeDownloadQueueItem(self, widget=''):
+        item = self.GetSelectedDownloadItem()
+        if item:
+            print(f"DEBUG: Resuming Download Of \"{item.file.name}\"")
+            self.download_scheduler.Resume(item)
+    
+    def CancelDownloadQueueItem(self, widget=''):
+        item = self.GetSelectedDownloadItem()
+        if item:
+            print(f"DEBUG: Cancelling Download Of \"{item.file.name}\"")
+            self.download_scheduler.Cancel(item)
+    
         #endregion
     
         #region Download Initialization
@@ -1493,38 +1803,72 @@ class KMExplorer(toga.App):
             ).future.result()
             
             if not download_folder:
-                download_folder = "%USERPROFILE%\\Downloads"
-            download_file = f"{download_folder}\\%s" 
-            
-            file_list = self.drive.ListFile({'q': f"'{self.google_folder_id}' in parents and trashed=false"}).GetList()
-            num_files = len(file_list)
-            
-            parts_per_file = ((NUM_DL_PARTS - 1) // num_files) + 1
-            
-            folder_size = sum(map(lambda f: int(f['fileSize']), file_list))
-            self.download_progress_label.text = f"Downloading all files in \"{folder_name}\" ({round(folder_size / 2**20, 2):0.1f} MB)"
-            
-            adjusted_folder_size = (folder_size + ((parts_per_file - 1) * num_files)) // ADJUSTED_PROGRESS_DIVIDER
-            print(f"Adjusted Folder Size for {folder_name}: {adjusted_folder_size}")
-            if adjusted_folder_size > (INT32_MAX * ADJUSTED_PROGRESS_DIVIDER):
-                return self.main_window.error_dialog(
-                    title="Folder Contents Exceed Max Download Size",
-                    message=f"The contents of {folder_name} exceed the maximum allowed download size for this application ({round((INT32_MAX * ADJUSTED_PROGRESS_DIVIDER) / 2**20, 2):0.1f} MB).\n\nPlease download the files individually."
-                )
+                download_folder = os.path.expandvars("%USERPROFILE%\\Downloads")
             
-            self.progress_bar.max = adjusted_folder_size
-            self.progress_bar.value = 0
+            folder_id = self.google_folder_id
+            self.download_progress_label.text = f"Downloading all files in \"{folder_name}\""
             
-            print(f"\nDownloading folder \"{folder_name}\"\nFolder size: {folder_size}\n")
+            print(f"\nDownloading folder \"{folder_name}\"\n")
             
             async def CustomDownloadFolder(widget, **kwargs):
-                self.progress_window.show()
-                self.progress_bar.start()
+                # The listing feeds the queue as it goes, so the folder size grows until the crawl finishes
+                progress = self.StartDownloadProgress(0)
+                
+                try:
+                    sync = FolderSync(str(download_folder), DELETE_REMOVED_FILES) if SYNC_FOLDER_DOWNLOADS else None
+                    paths = None if sync else DownloadPathPlanner(str(download_folder))
+                    job = self.telemetry.BeginJob(folder_name) if self.telemetry else None
+                    scheduler = self.download_engine.CreateScheduler(progress, FOLDER_DOWNLOAD_ORDER, MAX_DL_CONNECTIONS, NUM_DL_PARTS, on_change=self.RefreshDownloadQueue, adaptive=ADAPTIVE_DOWNLOADS, on_finish=sync.OnFinish if sync else None, job=job)
+                    self.download_scheduler = scheduler
+                    
+                    def AddFiles(files, relative_dir):
+                        for file in map(GetDriveFile, sorted(files, key=lambda f: f['name'])):
+                            download_path = sync.Plan(file, relative_dir) if sync else paths.GetPath(relative_dir, file.name)
+                            if download_path:
+                                progress.AddTotal(file.size)
+                                scheduler.Add(file, download_path)
+                        scheduler.Changed()
+                    
+                    walker = FolderWalker(self.drive_session, self.drive_token)
+                    
+                    self.RefreshDownloadQueue(scheduler)
+                    self.download_queue_window.show()
+                    
+                    scheduler.BeginAdding()
+                    listing = asyncio.ensure_future(walker.Walk(folder_id, AddFiles, RECURSIVE_FOLDER_DOWNLOADS))
+                    listing.add_done_callback(lambda _: scheduler.FinishAdding())
+                    
+                    success = await scheduler.Run()
+                    listed = await listing
+                    if job:
+                        self.telemetry.EndJob(job, success and listed)
+                    
+                    if sync:
+                        sync.Finish(scheduler.items, listed)
+                finally:
+                    self.download_queue_window.hide()
+                    self.download_scheduler = None
+                    
+                    await self.StopDownloadProgress()
                 
-                await asyncio.gather(*map(lambda i, file: asyncio.create_task(self.DownloadFile(File(file['id'], file['title'], file['fileSize']), download_file % file['title'], True, parts_per_file)), *zip(*enumerate(sorted(file_list, key = lambda x: x['title']), start=1))))
+                paused = scheduler.GetPausedItems()
+                if paused:
+                    self.main_window.info_dialog(
+                        title="Some Files Were Paused",
+                        message=f"{len(paused)} paused file(s) in \"{folder_name}\" were not downloaded.\n\nDownloading the folder to the same location again will resume them."
+                    )
                 
-                self.progress_bar.stop()
-                self.progress_window.hide()
+                if not listed:
+                    self.main_window.error_dialog(
+                        title="Some Folders Were Not Downloaded",
+                        message=f"{len(walker.failed_folders)} folder(s) in \"{folder_name}\" could not be listed, so their files were not downloaded.\n\n{next(iter(walker.errors.values()))}\n\nPlease try again later."
+                    )
+                
+                if sync and sync.failed_removals:
+                    self.main_window.error_dialog(
+                        title="Some Files Were Not Removed",
+                        message=f"{len(sync.failed_removals)} file(s) removed from Drive could not be deleted from \"{download_folder}\".\n\n{next(iter(sync.failed_removals.values()))}"
+                    )
                 
                 open_folder = self.main_window.question_dialog(
                     title="Opening Download Folder",
@@ -1542,7 +1886,14 @@ class KMExplorer(toga.App):
                 message="Please open a Google Drive folder and try again."
             )
     
-    def DownloadFileAndPlayInVLC(self, _file):        
+    async def DownloadFileAndPlayInVLC(self, _file):        
+        file = await self.GetGoogleDriveFile(_file)
+        
+        cached_path = self.media_cache.Lookup(file)
+        if cached_path:
+            self.PlayWithVLC(cached_path, file.name)
+            return
+        
         download_path = self.main_window.save_file_dialog(
             title="Save File From Google Drive",
             suggested_filename=_file.name
@@ -1550,29 +1901,24 @@ class KMExplorer(toga.App):
         
         if not download_path:
             return
-            
-        gdrive_file = self.drive.CreateFile({'id': _file.id})
-        gdrive_file.FetchMetadata(fields='fileSize')
-        
-        file = File(_file.id, _file.name, gdrive_file.metadata['fileSize'])
         
         self.download_progress_label.text = f"Downloading \"{file.name}\" ({file.GetSizeMB():0.1f} MB)"
-        self.progress_bar.max = (file.size + NUM_DL_PARTS - 1) // ADJUSTED_PROGRESS_DIVIDER
-        self.progress_bar.value = 0
         
         print(f"\nDownloading file \"{download_path}\"\nFile size: {file.size}\n")
         
         async def CustomDownloadFile(widget, **kwargs):
-            self.progress_window.show()
-            self.progress_bar.start()
+            progress = self.StartDownloadProgress(file.size)
             
-            # Each partial download is limited to 20 mbps and my internet speed is 250 mbps, 
-            # so I chose NUM_DL_PARTS = 12 because 12 * 20 mbps = 240 mbps. 
-            # You can adjust this number according to your own internet speed.
-            await self.DownloadFile(file, download_path, True, NUM_DL_PARTS)
+            try:
+                success = await self.download_engine.DownloadFile(file, download_path, progress, NUM_DL_PARTS, adaptive=ADAPTIVE_DOWNLOADS)
+            finally:
+                await self.StopDownloadProgress()
+            
+            if not success:
+                return
             
-            self.progress_bar.stop()
-            self.progress_window.hide()
+            if self.IsPlayableWithVLC(file.name):
+                self.media_cache.Add(file, str(download_path))
             
             open_file = self.main_window.question_dialog(
                 title="Download Finished",
@@ -1580,94 +1926,67 @@ class KMExplorer(toga.App):
             ).future.result()
             
             if open_file:
-                row = lambda: None
-                row.path = download_path
-                
-                self.OnDoubleClickLocalFile(row=row)
+                self.OpenLocalFile(LocalEntry.FromPath(download_path, self.IsPlayableWithVLC))
         
-        self.app.add_background_task(CustomDownloadFile)
-    
-        #endregion
-    
-        #region Asynchronous Downloads
-    
-    async def DownloadPart(self, file, show_progress_bar, start_byte, end_byte):
-        async with aiohttp.ClientSession(read_bufsize=MIN_CHUNK_SIZE) as client:
-            data = await self.FetchFile(client, file, show_progress_bar, partitioned=True, start_byte=start_byte, end_byte=end_byte)
-            
-        return data
-
-    async def DownloadFile(self, file : File, download_path, show_progress_bar, num_parts=None):
-        if num_parts and file.size >= (MIN_CHUNK_SIZE*100):
-            data_list = await asyncio.gather(*map(lambda part: self.DownloadPart(file, show_progress_bar, part[0], part[1]), file.CreatePartitions(num_parts)))
+        async def ProgressiveDownloadFile(widget, **kwargs):
+            progress = self.StartDownloadProgress(file.size)
+            loop = asyncio.get_running_loop()
             
-            if not data_list or not all(data_list):
-                data = None
-            else:
-                data = reduce(lambda a, b: a + b, data_list)
-                    
-        else:
-            async with aiohttp.ClientSession(read_bufsize=MIN_CHUNK_SIZE) as client:
-                data = await self.FetchFile(client, file, show_progress_bar)
+            try:
+                # The download runs on the streaming proxy's thread, so errors are handed back to the UI loop
+                download, result = self.stream_proxy.StartProgressive(
+                    file,
+                    str(download_path),
+                    progress,
+                    on_error=lambda title, message: loop.call_soon_threadsafe(self.ShowDownloadError, title, message)
+                )
                 
-        if not data:
-            self.main_window.error_dialog(
-                title="Download Failed",
-                message=f"Failed to download \"{file.name}\". Please try again later."
-            )
-            return
+                if await asyncio.wrap_future(self.stream_proxy.WaitUntilBuffered(download)):
+                    self.PlayWithVLC(self.GetGoogleDriveURL(file.id), file.name)
+                
+                success = await asyncio.wrap_future(result)
+            finally:
+                await self.StopDownloadProgress()
+            
+            if success and self.IsPlayableWithVLC(file.name):
+                self.media_cache.Add(file, str(download_path))
         
-        async with aiofiles.open(download_path, "wb") as f:
-            await f.write(data)
+        if PROGRESSIVE_PLAYBACK and self.IsPlayableWithVLC(file.name):
+            self.app.add_background_task(ProgressiveDownloadFile)
+        else:
+            self.app.add_background_task(CustomDownloadFile)
 
-        print(f"\nFinished Downloading \"{file.name}\"!\n")
+        #endregion
 
-    async def FetchFile(self, client : aiohttp.ClientSession, file : File, show_progress_bar, partitioned=False, start_byte=None, end_byte=None):
-        headers = {"Authorization": f"Bearer {self.gauth_token}",
-                   "Accept": "application/json"}
-        params = {"supportsAllDrives": "true"}
-        
-        download_string = f"Downloading \"{file.name}\""
-        
-        if partitioned:
-            headers["Range"] = f"bytes={start_byte}-{end_byte}"
-            download_string += f" from byte {start_byte} to {end_byte} ({end_byte - start_byte} bytes)"
-        
-        print(download_string)
-        
-        async with client.get(self.GetGoogleDriveURL(file.id), params=params, headers=headers) as resp:
-            if resp.status in [200, 206]:
-                data = bytearray()
-                if show_progress_bar and file.chunk_size >= MIN_CHUNK_SIZE:
-                    async for chunk, _ in resp.content.iter_chunks():
-                        data += chunk
-                        self.progress_bar.value += len(chunk) // ADJUSTED_PROGRESS_DIVIDER
-                    data = await self.FixTrashData(data, start_byte, end_byte)
-                    
-                else:
-                    data = await resp.content.read()
-                
-                return data
-            
-            else:
-                print(f"ERROR: Ecountered an error while {download_string}\nResponse Status: {resp.status}\nResponse Content: {resp.content}")
-                return None
-    
-    async def FixTrashData(self, data, start_byte, end_byte):
-        data_len = len(data)
-        difference = data_len - (end_byte - start_byte)
-        print(f"\nDownloaded {data_len}, Expected {end_byte - start_byte}; Difference = {difference}{f' ({data[-difference:]})' if difference else ''}")
-        
-        if (difference > 0):
-            data = data[:-difference]
-            data_len = len(data)
-            difference = data_len - (end_byte - start_byte)
-            print(f"After fix: Downloaded {data_len}, Expected {end_byte - start_byte}; Difference = {difference}")
-            
-        return data
+        #region Bandwidth Limit
+
+    def ShowBandwidthLimitPrompt(self, widget=''):
+        limit = self.bandwidth_limiter.mb_per_second
+        self.folder_name_input.value = f"{limit:g}" if limit else ''
+        self.folder_name_input_label.text = "Limit (MB/s, blank for unlimited): "
+        self.text_entry_window.title = SET_BANDWIDTH_LIMIT
+        self.folder_save_button.on_press = self.SetBandwidthLimit
+        self.text_entry_window._impl.native.ShowDialog(self.main_window._impl.native)
+
+    def SetBandwidthLimit(self, widget=''):
+        # Takes effect immediately for running downloads and streams
+        value = self.folder_name_input.value.strip()
+        self.CloseTextEntryWindow()
+
+        try:
+            limit = float(value) if value else None
+            if limit is not None and limit < 0:
+                raise ValueError(value)
+        except ValueError:
+            return self.main_window.error_dialog(
+                title="Invalid Bandwidth Limit",
+                message=f"\"{value}\" is not a valid bandwidth limit.\n\nPlease enter a number of MB/s, or leave it blank for unlimited."
+            )
+
+        self.bandwidth_limiter.SetLimit(limit)
 
         #endregion
-        
+
     #endregion
     
     #region Full Screen Overrides
@@ -1703,11 +2022,19 @@ class KMExplorer(toga.App):
             )
         )
         self.folder_table._impl.native.KeyDown += self.folder_table_KeyDown
+        self.navigation_generation = 0
+        self.navigation_task = None
+        self.navigation_target = None
         self.folder_repo = [[]]
         self.folder_repo_filename = ''
         
         self.LoadFolderRepo()
-        
+
+    def OnSelectFolderTableRow(self, *args, **kwargs):
+        row = kwargs.get("row")
+        if row is not None and self.folder_type == FolderType.GOOGLE_DRIVE:
+            self.OnSelectGoogleDriveFile(row)
+
     def folder_table_KeyDown(self, sender, event):
         print(f"DEBUG: Key Entered In Folder Table: {event.KeyCode}")
         if event.KeyCode == _DELETE:
@@ -1772,38 +2099,97 @@ class KMExplorer(toga.App):
                 flex=1, 
                 padding=5
             ),
-            on_double_click=on_double_click
+            on_double_click=on_double_click,
+            on_select=self.OnSelectFolderTableRow
         )
         self.folder_table._impl.native.KeyDown += self.folder_table_KeyDown
         
         if len(headings) > 0:
             self.folder_table._impl.native.Columns[0].Width = 400
-            if len(headings) == 2:
-                self.folder_table._impl.native.Columns[1].Width = 200
+            for column, heading in enumerate(headings[1:], 1):
+                self.folder_table._impl.native.Columns[column].Width = COLUMN_WIDTHS.get(heading, 200)
         
         self.main_box.add(self.folder_table)
-        self.main_window.title = f"{self.formal_name} - {self.GetFolderName()}"
+        self.UpdateTitle()
         self.folder_table.focus()
         
     def SetFolderTable(self, folder_str):
-        if self.folder_type == FolderType.INVALID:
+        # The current table stays up, and keeps its folder type, until the new folder has been read
+        folder_type = self.GetFolderType(folder_str)
+        
+        if folder_type == FolderType.INVALID:
             return self.main_window.error_dialog(
                 title="Invalid Input",
                 message="Please enter a valid folder location."
             )
         
-        if self.folder_type == FolderType.GOOGLE_DRIVE:
+        if folder_type == FolderType.GOOGLE_DRIVE:
             self.SetFolderTableGoogleDrive(folder_url=folder_str)
-        elif self.folder_type == FolderType.LOCAL_OR_NETWORK:
+        elif folder_type == FolderType.LOCAL_OR_NETWORK:
             self.SetFolderTableLocal(folder_str)
          
     #endregion
     
+    #region Navigation
+    
+    def StartNavigation(self, navigation, target):
+        # Runs navigation(generation) as a background task, with target shown as loading until it finishes.
+        # Starting another navigation cancels this one, and IsCurrentNavigation(generation) turns False
+        # so nothing it was about to show reaches the folder table.
+        generation = self.CancelNavigation()
+        self.ShowNavigationLoading(target)
+        
+        async def RunNavigation(widget, **kwargs):
+            if not self.IsCurrentNavigation(generation):
+                return
+            self.navigation_task = asyncio.current_task()
+            
+            try:
+                await navigation(generation)
+            except asyncio.CancelledError:
+                print(f"DEBUG: Cancelled loading \"{target}\"")
+            finally:
+                if self.IsCurrentNavigation(generation):
+                    self.navigation_task = None
+                    self.HideNavigationLoading()
+        
+        self.add_background_task(RunNavigation)
+    
+    def CancelNavigation(self):
+        self.navigation_generation += 1
+        if self.navigation_task:
+            self.navigation_task.cancel()
+            self.navigation_task = None
+        self.HideNavigationLoading()
+        return self.navigation_generation
+    
+    def IsCurrentNavigation(self, generation):
+        return generation == self.navigation_generation
+    
+    def ShowNavigationLoading(self, target):
+        self.navigation_target = target
+        self.main_window._impl.native.Cursor = WinForms.Cursors.AppStarting
+        self.UpdateTitle()
+    
+    def HideNavigationLoading(self):
+        if self.navigation_target is None:
+            return
+        self.navigation_target = None
+        self.main_window._impl.native.Cursor = WinForms.Cursors.Default
+        self.UpdateTitle()
+    
+    def UpdateTitle(self):
+        if self.navigation_target is not None:
+            self.main_window.title = f"{self.formal_name} - Loading \"{self.navigation_target}\"..."
+        else:
+            self.main_window.title = f"{self.formal_name} - {self.GetFolderName()}"
+    
+    #endregion
+    
     def GetFolderName(self):
         if self.folder_type == FolderType.GOOGLE_DRIVE:
-            folder = self.drive.CreateFile({'id': self.google_folder_id})
-            folder.FetchMetadata(fields='title')
-            return folder['title']
+            # The name arrives with the listing; until then the folder id stands in for it
+            return self.google_folder_name or self.google_folder_id
         if self.folder_type == FolderType.LOCAL_OR_NETWORK:
             folder = self.local_folder_path
             path_list = folder.split('\\')
@@ -1814,9 +2200,8 @@ class KMExplorer(toga.App):
         
     def OnClickGetFolderContents(self, widget=''):
         folder_str = self.folder_input.value
-        self.SetFolderType(folder_str)
         
-        if self.folder_type == FolderType.GOOGLE_DRIVE and not self.google_authenticated:
+        if self.GetFolderType(folder_str) == FolderType.GOOGLE_DRIVE and not self.google_authenticated:
             if not self.GoogleAuthentication():
                 return
             
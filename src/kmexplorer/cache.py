@@ -0,0 +1,172 @@
+"""
+On-disk cache of played Google Drive media, evicted least recently used first
+"""
+import os
+import re
+import json
+import shutil
+from time import time
+from kmexplorer.download import MANIFEST_EXTENSION, PARTIAL_EXTENSION
+
+MEDIA_CACHE_SIZE = 20 * 2**30
+MEDIA_CACHE_INDEX_NAME = "index.json"
+
+class MediaCache:
+    # Each entry is keyed by the Drive file id and its md5Checksum (or modifiedDate when Drive
+    # has no checksum), so a file that changes on Drive is never served from a stale copy.
+    # Cached files keep their original extension so VLC picks the right demuxer.
+    def __init__(self, directory, max_bytes=MEDIA_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, MEDIA_CACHE_INDEX_NAME)
+        self.entries = None
+
+    #region Index
+
+    def Load(self):
+        if self.entries is None:
+            try:
+                with open(self.index_path, "r", encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def Save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def GetKey(self, file):
+        version = file.md5 if file.md5 else re.sub(r"\D", "", file.modified or "")
+        if not version:
+            return None
+        return f"{file.id}-{version}"
+
+    def GetPath(self, file):
+        key = self.GetKey(file)
+        if key is None:
+            return None
+        return os.path.join(self.directory, key + os.path.splitext(file.name)[1].lower())
+
+    def GetSize(self):
+        return sum(entry['size'] for entry in self.Load().values())
+
+    #endregion
+
+    #region Entries
+
+    def Contains(self, file):
+        # Like Lookup, without marking the entry as used
+        entry = self.Load().get(self.GetKey(file))
+        return entry is not None and os.path.isfile(os.path.join(self.directory, entry['name']))
+
+    def Lookup(self, file):
+        # Returns the cached path and marks it as recently used, or None on a miss
+        key = self.GetKey(file)
+        entry = self.Load().get(key)
+        if entry is None:
+            return None
+
+        path = os.path.join(self.directory, entry['name'])
+        if not os.path.isfile(path) or os.path.getsize(path) != file.size:
+            print(f"DEBUG: Dropping stale media cache entry \"{key}\"")
+            self.Remove(key)
+            return None
+
+        entry['last_used'] = time()
+        self.Save()
+        print(f"DEBUG: Media cache hit for \"{file.name}\"")
+        return path
+
+    def Reserve(self, file):
+        # Makes room for file and returns the path to download it to, or None if it can never fit
+        path = self.GetPath(file)
+        if path is None or file.size > self.max_bytes:
+            return None
+
+        self.RemoveVersions(file.id, keep=self.GetKey(file))
+        self.Evict(file.size, keep=self.GetKey(file))
+        os.makedirs(self.directory, exist_ok=True)
+        return path
+
+    def Commit(self, file):
+        path = self.GetPath(file)
+        self.Load()[self.GetKey(file)] = {
+            'id': file.id,
+            'name': os.path.basename(path),
+            'size': file.size,
+            'last_used': time()
+        }
+        self.Save()
+        return path
+
+    def Add(self, file, source_path):
+        # Hard links cost nothing when the source is on the same volume; otherwise the file is copied
+        path = self.Reserve(file)
+        if path is None:
+            return None
+
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            try:
+                os.link(source_path, path)
+            except OSError:
+                shutil.copyfile(source_path, path)
+        except OSError as err:
+            print(f"DEBUG: Unable to add \"{source_path}\" to the media cache: {err}")
+            return None
+
+        return self.Commit(file)
+
+    def Remove(self, key):
+        entry = self.Load().pop(key, None)
+        if entry is not None:
+            path = os.path.join(self.directory, entry['name'])
+            for stale_path in [path, path + MANIFEST_EXTENSION, path + PARTIAL_EXTENSION]:
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+            self.Save()
+
+    def RemoveVersions(self, file_id, keep=None):
+        for key, entry in list(self.Load().items()):
+            if entry['id'] == file_id and key != keep:
+                print(f"DEBUG: Removing outdated media cache entry \"{key}\"")
+                self.Remove(key)
+
+    def RemovePartial(self, keep=None):
+        # Drops partly filled copies outside the index, except keep; files still being written are left for next time
+        names = {entry['name'] for entry in self.Load().values()} | {MEDIA_CACHE_INDEX_NAME}
+        if keep:
+            names.add(os.path.basename(keep))
+        try:
+            paths = [entry.path for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError:
+            return
+        for path in paths:
+            name = os.path.basename(path)
+            for extension in [MANIFEST_EXTENSION, PARTIAL_EXTENSION]:
+                if name.endswith(extension):
+                    name = name[:-len(extension)]
+            if name not in names and not name.endswith(".tmp"):
+                try:
+                    os.remove(path)
+                    print(f"DEBUG: Removed partial media cache file \"{os.path.basename(path)}\"")
+                except OSError:
+                    pass
+
+    def Evict(self, num_bytes, keep=None):
+        entries = self.Load()
+        for key in sorted(entries, key=lambda key: entries[key]['last_used']):
+            if self.GetSize() + num_bytes <= self.max_bytes:
+                break
+            if key != keep:
+                print(f"DEBUG: Evicting \"{key}\" from the media cache")
+                self.Remove(key)
+
+    #endregion
@@ -0,0 +1,207 @@
+"""
+Headless Google Drive downloads, without toga or WinForms
+
+    python -m kmexplorer download <file-or-folder-id> --out DIR
+
+Progress is written to stdout as JSON lines; debug output goes to stderr.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+from time import time, monotonic
+from contextlib import redirect_stdout
+from kmexplorer.download import DownloadOrder, DownloadState, ProgressAggregator
+from kmexplorer.drive import DriveSession, DriveToken, IsDownloadableMimeType, DRIVE_FOLDER_MIME_TYPE
+from kmexplorer.client import DriveClient
+from kmexplorer.sync import FolderSync
+from kmexplorer.telemetry import Telemetry, TelemetryFormat
+from kmexplorer.limiter import BandwidthLimiter, ParseBandwidthWindow
+from kmexplorer.engine import DownloadEngine, FolderWalker, DownloadPathPlanner, GetDriveFile, GetLocalFileName, NUM_DL_PARTS, MAX_DL_CONNECTIONS, WALK_MAX_LISTINGS
+
+DEFAULT_CREDENTIALS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "user_creds.json")
+TOKEN_ENVIRONMENT_VARIABLE = "KMEXPLORER_ACCESS_TOKEN"
+PROGRESS_INTERVAL = 1
+
+class EventWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def Emit(self, event, **fields):
+        self.stream.write(json.dumps({'event': event, 'time': round(time(), 3), **fields}) + '\n')
+        self.stream.flush()
+
+    def EmitProgress(self, progress : ProgressAggregator):
+        eta = progress.GetETA()
+        speed = progress.GetSpeed()
+        self.Emit(
+            'progress',
+            done_bytes=progress.done_bytes,
+            total_bytes=progress.total_bytes,
+            fraction=round(progress.GetFraction(), 4),
+            bytes_per_second=round(speed),
+            mbps=round(speed * 8 / 10**6, 2),
+            eta_seconds=None if eta is None else round(eta, 1)
+        )
+
+#region Authentication
+
+def LoadToken(args):
+    access_token = args.token or os.environ.get(TOKEN_ENVIRONMENT_VARIABLE)
+    if access_token:
+        return DriveToken(access_token=access_token)
+
+    from pydrive2.auth import GoogleAuth
+
+    gauth = GoogleAuth()
+    gauth.LoadCredentialsFile(args.credentials)
+
+    if gauth.credentials is None:
+        raise SystemExit(f"No saved Google credentials at \"{args.credentials}\". Sign in once with the app, or pass --token.")
+
+    if gauth.access_token_expired:
+        gauth.Refresh()
+        gauth.SaveCredentialsFile(args.credentials)
+
+    return DriveToken(gauth, args.credentials)
+
+#endregion
+
+#region Drive Metadata
+
+async def FetchMetadata(drive_session, token, file_id):
+    return await DriveClient(drive_session, token).GetFile(file_id)
+
+#endregion
+
+#region Download
+
+async def Download(args, events : EventWriter):
+    drive_session = DriveSession(limit_per_host=max(args.connections, NUM_DL_PARTS))
+    token = LoadToken(args)
+    telemetry = Telemetry(args.telemetry, TelemetryFormat(args.telemetry_format)) if args.telemetry else None
+    limiter = BandwidthLimiter(args.limit, args.limit_schedule) if args.limit or args.limit_schedule else None
+    engine = DownloadEngine(drive_session, token, on_error=lambda title, message: events.Emit('error', title=title, message=message), telemetry=telemetry, limiter=limiter)
+    os.makedirs(args.out, exist_ok=True)
+
+    try:
+        metadata = await FetchMetadata(drive_session, token, args.id)
+        is_folder = metadata['mimeType'] == DRIVE_FOLDER_MIME_TYPE
+
+        if not is_folder and not IsDownloadableMimeType(metadata['mimeType']):
+            events.Emit('error', title="Not Downloadable", message=f"\"{metadata['name']}\" is a {metadata['mimeType']} and has no binary content")
+            return False
+
+        # Folder sizes are only known once the listing finishes, so the total grows as files are found
+        progress = ProgressAggregator(0 if is_folder else metadata.get('size', 0))
+        events.Emit('start', id=args.id, name=metadata['name'], folder=is_folder, recursive=args.recursive, out=os.path.abspath(args.out))
+
+        progress_task = asyncio.ensure_future(progress.Run(events.EmitProgress, args.interval))
+        start_time = monotonic()
+
+        if is_folder:
+            states = {}
+
+            def OnChange(scheduler):
+                for item in scheduler.items:
+                    if states.get(item.index) != item.state:
+                        states[item.index] = item.state
+                        events.Emit('file', id=item.file.id, name=item.file.name, size=item.file.size, state=item.state.value)
+
+            order = DownloadOrder.LISTING if args.order == 'listing' else DownloadOrder.SMALLEST_FIRST
+            sync = FolderSync(args.out, args.delete) if args.sync else None
+            paths = None if sync else DownloadPathPlanner(args.out)
+            job = telemetry.BeginJob(metadata['name']) if telemetry else None
+            scheduler = engine.CreateScheduler(progress, order, args.connections, args.parts or NUM_DL_PARTS, on_change=OnChange, adaptive=not args.parts, on_finish=sync.OnFinish if sync else None, job=job)
+
+            def AddFiles(files, relative_dir):
+                for file in map(GetDriveFile, sorted(files, key=lambda f: f['name'])):
+                    download_path = sync.Plan(file, relative_dir) if sync else paths.GetPath(relative_dir, file.name)
+                    if download_path:
+                        progress.AddTotal(file.size)
+                        scheduler.Add(file, download_path)
+                    else:
+                        events.Emit('file', id=file.id, name=file.name, size=file.size, state="Unchanged")
+                scheduler.Changed()
+
+            walker = FolderWalker(drive_session, token, max_listings=args.listings)
+            scheduler.BeginAdding()
+            listing = asyncio.ensure_future(walker.Walk(args.id, AddFiles, args.recursive))
+            listing.add_done_callback(lambda _: scheduler.FinishAdding())
+
+            success = await scheduler.Run()
+            listed = await listing
+            if not listed:
+                events.Emit('error', title="Listing Incomplete", message=f"{len(walker.failed_folders)} folders could not be listed: {', '.join(f'{folder_id} ({err})' for folder_id, err in walker.errors.items())}")
+
+            if sync:
+                for removed_path in sync.Finish(scheduler.items, listed):
+                    events.Emit('removed', path=removed_path)
+                for local_path, err in sync.failed_removals.items():
+                    events.Emit('error', title="Unable to Remove File", message=f"\"{local_path}\" was removed from Drive but could not be deleted: {err}")
+
+            files = scheduler.items
+            success = success and listed and not any(item.state != DownloadState.DONE for item in scheduler.items)
+            if job:
+                telemetry.EndJob(job, success)
+
+        else:
+            file = GetDriveFile(metadata)
+            files = [file]
+            success = await engine.DownloadFile(file, os.path.join(args.out, GetLocalFileName(file.name)), progress, args.parts or NUM_DL_PARTS, adaptive=not args.parts)
+            events.Emit('file', id=file.id, name=file.name, size=file.size, state=(DownloadState.DONE if success else DownloadState.FAILED).value)
+
+        duration = monotonic() - start_time
+        progress.Stop()
+        await progress_task
+
+        events.Emit(
+            'done',
+            success=success,
+            files=len(files),
+            done_bytes=progress.done_bytes,
+            transferred_bytes=progress.transferred_bytes,
+            duration_seconds=round(duration, 3),
+            mbps=round(progress.transferred_bytes * 8 / duration / 10**6, 2) if duration > 0 else 0
+        )
+        return success
+
+    finally:
+        await drive_session.Close()
+
+#endregion
+
+def CreateParser():
+    parser = argparse.ArgumentParser(prog="python -m kmexplorer", description="Download Google Drive files and folders without the GUI")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    download = commands.add_parser('download', help="Download a Drive file, or every file in a Drive folder")
+    download.add_argument('id', help="Drive file or folder ID")
+    download.add_argument('--out', required=True, help="Directory to download into")
+    download.add_argument('--parts', type=int, default=None, help="Fixed number of ranges per file (single files default to adaptive ranges)")
+    download.add_argument('--connections', type=int, default=MAX_DL_CONNECTIONS, help="Maximum concurrent connections for folder downloads")
+    download.add_argument('--recursive', action='store_true', help="Also download every subfolder, recreating the folder structure")
+    download.add_argument('--sync', action='store_true', help="Only download folder files that are new or changed since the last sync into --out")
+    download.add_argument('--delete', action='store_true', help="With --sync, delete synced files that were removed from Drive")
+    download.add_argument('--listings', type=int, default=WALK_MAX_LISTINGS, help="Maximum folders listed at once with --recursive")
+    download.add_argument('--order', choices=['smallest', 'listing'], default='smallest', help="Order to download folder contents in")
+    download.add_argument('--interval', type=float, default=PROGRESS_INTERVAL, help="Seconds between progress events")
+    download.add_argument('--credentials', default=DEFAULT_CREDENTIALS_PATH, help="Saved pydrive2 credentials file")
+    download.add_argument('--limit', type=float, default=None, help="Bandwidth limit in MB/s across all connections")
+    download.add_argument('--limit-schedule', type=ParseBandwidthWindow, nargs='+', default=[], metavar="HH:MM-HH:MM=MBPS", help="Daily windows with their own bandwidth limit, e.g. 09:00-17:00=2 (0 for unlimited)")
+    download.add_argument('--telemetry', default=None, help="Directory to write per-transfer metrics to after each file or folder job")
+    download.add_argument('--telemetry-format', choices=[f.value for f in TelemetryFormat], default=TelemetryFormat.JSONL.value, help="Write --telemetry as JSON lines or Prometheus text")
+    download.add_argument('--token', default=None, help=f"Bearer access token to use instead of saved credentials (or set {TOKEN_ENVIRONMENT_VARIABLE})")
+
+    return parser
+
+def main(argv=None):
+    args = CreateParser().parse_args(argv)
+    events = EventWriter(sys.stdout)
+
+    # The engine's debug prints would interleave with the JSON events, so they go to stderr
+    with redirect_stdout(sys.stderr):
+        success = asyncio.run(Download(args, events))
+
+    return 0 if success else 1
@@ -0,0 +1,175 @@
+"""
+Async Google Drive v3 client for files.list, files.get, batch and changes requests
+"""
+import re
+import json
+import asyncio
+import aiohttp
+from urllib.parse import urlsplit, urlencode
+from kmexplorer.drive import DriveSession, DriveToken, DriveRequestError, RetryPolicy, GetDriveJSON, DRIVE_FILES_URL, DRIVE_BATCH_URL, DRIVE_CHANGES_URL
+
+DRIVE_FILE_FIELDS = "id,name,mimeType,size,md5Checksum,modifiedTime"
+LIST_PAGE_SIZE = 1000
+
+class DriveClient:
+    # Drive v3 metadata requests over the shared DriveSession, authorized with the DriveToken that
+    # GoogleAuthenticate creates. Every request is retried with retry_policy, refreshing the token when it expires.
+    def __init__(self, drive_session : DriveSession, token : DriveToken = None, retry_policy=None):
+        self.drive_session = drive_session
+        self.token = token
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+
+    async def Retry(self, request):
+        # Awaits request() until it succeeds, re-raising the last error once retries run out
+        attempt = 0
+
+        while True:
+            token = self.token.Get()
+            retry_after = None
+
+            try:
+                return await request()
+
+            except DriveRequestError as err:
+                if err.IsAuthError():
+                    if not await self.token.Refresh(token):
+                        raise
+                elif err.IsRetryable():
+                    retry_after = err.retry_after
+                else:
+                    raise
+                if attempt >= self.retry_policy.max_retries:
+                    raise
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retry_policy.max_retries:
+                    raise
+
+            await asyncio.sleep(self.retry_policy.GetDelay(attempt, retry_after))
+            attempt += 1
+
+    async def GetJSON(self, url, params):
+        return await self.Retry(lambda: GetDriveJSON(self.drive_session, self.token, url, params))
+
+    #region Files
+
+    async def GetFile(self, file_id, fields=DRIVE_FILE_FIELDS):
+        return await self.GetJSON(f"{DRIVE_FILES_URL}/{file_id}", {'fields': fields, 'supportsAllDrives': 'true'})
+
+    async def GetFiles(self, file_ids, fields=DRIVE_FILE_FIELDS):
+        # One batch request for every id (at most 100). Returns {file_id: metadata or DriveRequestError},
+        # since files in a batch succeed or fail on their own.
+        return await self.Retry(lambda: self.FetchBatch(file_ids, fields))
+
+    async def ListFolder(self, folder_id, order_by=None, fields=DRIVE_FILE_FIELDS):
+        # Yields each page of the folder's files and folders as it arrives
+        params = {
+            'q': f"'{folder_id}' in parents and trashed=false",
+            'fields': f"nextPageToken,files({fields})",
+            'pageSize': LIST_PAGE_SIZE,
+            'supportsAllDrives': 'true',
+            'includeItemsFromAllDrives': 'true'
+        }
+        if order_by:
+            params['orderBy'] = order_by
+
+        while True:
+            page = await self.GetJSON(DRIVE_FILES_URL, params)
+            yield page.get('files', [])
+            if not page.get('nextPageToken'):
+                return
+            params['pageToken'] = page['nextPageToken']
+
+    #endregion
+
+    #region Changes
+
+    async def GetStartPageToken(self):
+        response = await self.GetJSON(f"{DRIVE_CHANGES_URL}/startPageToken", {'supportsAllDrives': 'true'})
+        return response['startPageToken']
+
+    async def ListChanges(self, page_token, fields=DRIVE_FILE_FIELDS):
+        # Yields each page of changes since page_token; the last page carries newStartPageToken
+        params = {
+            'pageToken': page_token,
+            'pageSize': LIST_PAGE_SIZE,
+            'fields': f"nextPageToken,newStartPageToken,changes(changeType,fileId,removed,file({fields},parents,trashed))",
+            'includeRemoved': 'true',
+            'supportsAllDrives': 'true',
+            'includeItemsFromAllDrives': 'true'
+        }
+
+        while True:
+            page = await self.GetJSON(DRIVE_CHANGES_URL, params)
+            yield page
+            if not page.get('nextPageToken'):
+                return
+            params['pageToken'] = page['nextPageToken']
+
+    #endregion
+
+    #region Batch
+
+    async def FetchBatch(self, file_ids, fields):
+        boundary = f"kmexplorer_batch_{id(file_ids):x}"
+        files_path = urlsplit(DRIVE_FILES_URL).path
+        query = urlencode({'fields': fields, 'supportsAllDrives': 'true'})
+
+        parts = []
+        for index, file_id in enumerate(file_ids):
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <item{index}>\r\n\r\n"
+                f"GET {files_path}/{file_id}?{query}\r\n\r\n"
+            )
+        body = ''.join(parts) + f"--{boundary}--\r\n"
+
+        headers = self.token.GetHeaders()
+        headers["Content-Type"] = f"multipart/mixed; boundary={boundary}"
+
+        async with self.drive_session.GetSession().post(DRIVE_BATCH_URL, data=body.encode('utf-8'), headers=headers) as resp:
+            if resp.status != 200:
+                raise DriveRequestError(resp.status, await resp.text(), resp.headers.get("Retry-After"))
+            responses = ParseBatchResponse(resp.headers.get("Content-Type", ""), await resp.text())
+
+        results = {}
+        for index, file_id in enumerate(file_ids):
+            if f"item{index}" not in responses:
+                continue
+            status, part_headers, payload = responses[f"item{index}"]
+            if status == 200:
+                results[file_id] = json.loads(payload)
+            else:
+                results[file_id] = DriveRequestError(status, payload, part_headers.get("retry-after"))
+        return results
+
+    #endregion
+
+def ParseBatchResponse(content_type, body):
+    # Splits a multipart/mixed batch response into {content id: (status, headers, body)}.
+    # Drive answers Content-ID <itemN> with <response-itemN>.
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise DriveRequestError(502, f"Batch response has no boundary: {content_type}")
+
+    responses = {}
+    for part in body.replace('\r\n', '\n').split(f"--{match.group(1)}"):
+        part = part.strip()
+        if not part or part == '--':
+            continue
+
+        part_headers, _, http_response = part.partition('\n\n')
+        content_id = re.search(r"^content-id:\s*<?(?:response-)?([^>\s]+)>?", part_headers, re.IGNORECASE | re.MULTILINE)
+        status_line, _, rest = http_response.partition('\n')
+        if not content_id or not status_line.startswith("HTTP/"):
+            continue
+
+        response_headers, _, payload = rest.partition('\n\n')
+        headers = {}
+        for line in response_headers.split('\n'):
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        responses[content_id.group(1)] = (int(status_line.split()[1]), headers, payload.strip())
+
+    return responses
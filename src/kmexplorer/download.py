@@ -0,0 +1,870 @@
+"""
+Write partitioned Google Drive downloads straight to disk
+"""
+import os
+import json
+import heapq
+import hashlib
+import asyncio
+import aiofiles
+import threading
+from enum import Enum
+from collections import deque
+from time import monotonic
+
+WRITE_BUFFER_SIZE = 2**20
+MANIFEST_EXTENSION = ".kmpart"
+# Downloads are written here and only replace the file at the download path once complete
+PARTIAL_EXTENSION = ".kmdownload"
+MANIFEST_SAVE_INTERVAL = 1
+# Indexes and caches live here instead of in the user's download folders
+USER_CACHE_DIR = os.environ.get("KMEXPLORER_CACHE_DIR", os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser(os.path.join("~", ".cache")), "kmexplorer"))
+VERIFIED_INDEX_DIR = os.path.join(USER_CACHE_DIR, "verified")
+HASH_REORDER_WINDOW = 2**26
+# Shared by every file being hashed, so many concurrent downloads can't each hold a full window in memory
+HASH_BUFFER_LIMIT = 2**27
+
+ADAPTIVE_BLOCK_SIZE = 2**23
+ADAPTIVE_MIN_RANGES = 1
+ADAPTIVE_MAX_RANGES = 32
+ADAPTIVE_SAMPLE_INTERVAL = 2
+ADAPTIVE_GAIN_THRESHOLD = 0.05
+ADAPTIVE_LOSS_THRESHOLD = 0.2
+
+PROGRESS_UPDATE_INTERVAL = 0.1
+PROGRESS_SPEED_WINDOW = 5
+PROGRESS_SCALE = 10000
+
+#region Range Planning
+
+class RangeResponseError(Exception):
+    pass
+
+class RangePlanner:
+    # Ranges are planned as half-open (start_byte, end_byte) pairs, matching the manifest and writers.
+    # HTTP Range and Content-Range are inclusive, so the conversion happens only here.
+    def __init__(self, size):
+        self.size = int(size)
+
+    def CreatePartitions(self, num_parts):
+        num_parts = max(1, min(num_parts, self.size))
+        part_size = self.size // num_parts
+        remainder = self.size - (part_size * num_parts)
+
+        part_size_list = [part_size] * num_parts
+        part_size_list[0] += remainder
+
+        start_byte = 0
+        partitions = []
+        
+        for _part_size in part_size_list:
+            partitions.append((start_byte, _part_size + start_byte))
+            start_byte += _part_size
+        
+        return partitions
+
+    def CreateBlocks(self, block_size):
+        return [(start_byte, min(start_byte + block_size, self.size)) for start_byte in range(0, self.size, block_size)]
+
+    def GetRangeHeader(self, start_byte, end_byte):
+        return f"bytes={start_byte}-{end_byte - 1}"
+
+    def ValidateResponse(self, status, headers, start_byte, end_byte, requested_range=True):
+        # Checked before any data is accepted, so a bad response never reaches the file
+        content_length = headers.get("Content-Length")
+        expected_length = end_byte - start_byte
+        
+        if not requested_range:
+            if status != 200:
+                raise RangeResponseError(f"Expected status 200 for the whole file, got {status}")
+        else:
+            if status != 206:
+                raise RangeResponseError(f"Expected status 206 for bytes {start_byte}-{end_byte - 1}, got {status}")
+            
+            content_range = ParseContentRange(headers.get("Content-Range"))
+            if content_range is None:
+                raise RangeResponseError(f"Missing or invalid Content-Range: {headers.get('Content-Range')}")
+            
+            first_byte, last_byte, total = content_range
+            if (first_byte, last_byte) != (start_byte, end_byte - 1) or (total is not None and total != self.size):
+                raise RangeResponseError(f"Requested bytes {start_byte}-{end_byte - 1}/{self.size}, got {first_byte}-{last_byte}/{total}")
+        
+        if content_length is not None and ParseContentLength(content_length) != expected_length:
+            raise RangeResponseError(f"Expected Content-Length {expected_length}, got {content_length}")
+
+def ParseContentLength(content_length):
+    # A malformed length is returned as None, so it fails validation like any other wrong length
+    try:
+        return int(content_length)
+    except ValueError:
+        return None
+
+def ParseContentRange(content_range):
+    # "bytes first-last/total", where total may be "*"
+    try:
+        unit, span = content_range.split(' ', 1)
+        byte_range, total = span.split('/', 1)
+        first_byte, last_byte = byte_range.split('-', 1)
+        if unit != 'bytes':
+            return None
+        return int(first_byte), int(last_byte), None if total == '*' else int(total)
+    except (AttributeError, ValueError):
+        return None
+
+#endregion
+
+#region Range Manifest
+
+class DownloadManifest:
+    # Sidecar file recording how many bytes of each partition have reached the disk,
+    # so an interrupted download only needs to re-request what is missing.
+    def __init__(self, download_path):
+        self.path = download_path + MANIFEST_EXTENSION
+        self.file_id = None
+        self.size = None
+        self.ranges = {}
+        self.last_save = 0
+
+    def Exists(self):
+        return os.path.isfile(self.path)
+
+    def Create(self, file_id, size, partitions):
+        self.file_id = file_id
+        self.size = int(size)
+        self.ranges = {start_byte: [end_byte, 0] for start_byte, end_byte in partitions}
+        self.Save()
+
+    def Load(self):
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.file_id = manifest['id']
+            self.size = int(manifest['size'])
+            self.ranges = {int(start_byte): [int(end_byte), int(written)] for start_byte, end_byte, written in manifest['ranges']}
+            return True
+        except Exception as err:
+            print(f"DEBUG: Unable to load download manifest \"{self.path}\": {err}")
+            return False
+
+    def Save(self):
+        manifest = {
+            'id': self.file_id,
+            'size': self.size,
+            'ranges': [[start_byte, end_byte, written] for start_byte, (end_byte, written) in sorted(self.ranges.items())]
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self.path)
+        self.last_save = monotonic()
+
+    def Remove(self):
+        if self.Exists():
+            os.remove(self.path)
+
+    def Matches(self, file_id, size):
+        return self.file_id == file_id and self.size == int(size)
+
+    def GetWritten(self, start_byte):
+        return self.ranges[start_byte][1]
+
+    def GetBytesComplete(self):
+        return sum(written for _, written in self.ranges.values())
+
+    def GetMissingRanges(self):
+        return [(start_byte, end_byte) for start_byte, (end_byte, written) in sorted(self.ranges.items()) if written < end_byte - start_byte]
+
+    def Update(self, start_byte, written, force=False):
+        self.ranges[start_byte][1] = written
+        if force or monotonic() - self.last_save >= MANIFEST_SAVE_INTERVAL:
+            self.Save()
+
+#endregion
+
+#region Integrity Verification
+
+class HashBufferBudget:
+    # Hashers run on both the app's loop and the streaming proxy's thread, so the count is locked
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def Reserve(self, num_bytes):
+        with self.lock:
+            if self.used + num_bytes > self.limit:
+                return False
+            self.used += num_bytes
+            return True
+
+    def Release(self, num_bytes):
+        with self.lock:
+            self.used -= num_bytes
+
+HASH_BUFFER_BUDGET = HashBufferBudget(HASH_BUFFER_LIMIT)
+
+class StreamingHasher:
+    # MD5 has to consume the file strictly in order. Flushed spans that continue the hashed prefix are
+    # hashed straight from the write buffer, and spans less than window bytes ahead of it are held in
+    # memory until the prefix reaches them, as long as the budget shared by all hashers has room. Ranges
+    # fetched as in-order blocks stay inside the window, so the file is rarely read back. Spans further
+    # ahead, spans past the budget and spans written before a resume are read back by a background task,
+    # so the range that flushed them never waits on the read.
+    def __init__(self, path, size, window=HASH_REORDER_WINDOW, budget=HASH_BUFFER_BUDGET):
+        self.path = path
+        self.size = size
+        self.window = window
+        self.budget = budget
+        self.md5 = hashlib.md5()
+        self.offset = 0
+        self.buffered = {}
+        self.pending = {}
+        self.catch_up = None
+        self.closed = False
+
+    def AddPending(self, start_byte, end_byte):
+        if end_byte > start_byte:
+            self.pending[start_byte] = end_byte
+
+    def Update(self, start_byte, data):
+        # data must not change afterwards; RangeWriter starts a new buffer after every flush
+        if self.closed:
+            return
+
+        if start_byte == self.offset:
+            self.md5.update(data)
+            self.offset += len(data)
+            self.HashBuffered()
+        elif start_byte + len(data) <= self.offset + self.window and self.budget.Reserve(len(data)):
+            self.buffered[start_byte] = data
+        else:
+            self.AddPending(start_byte, start_byte + len(data))
+
+        if self.offset in self.pending and (self.catch_up is None or self.catch_up.done()):
+            self.catch_up = asyncio.ensure_future(self.CatchUp())
+
+    def HashBuffered(self):
+        while self.offset in self.buffered:
+            data = self.buffered.pop(self.offset)
+            self.budget.Release(len(data))
+            self.md5.update(data)
+            self.offset += len(data)
+
+    def Close(self):
+        # Hands back whatever an unfinished download still holds
+        self.closed = True
+        self.budget.Release(sum(len(data) for data in self.buffered.values()))
+        self.buffered = {}
+
+    async def CatchUp(self):
+        # Nothing else is written to a pending span, so the offset only moves here while one is being read
+        async with aiofiles.open(self.path, "rb") as f:
+            while self.offset in self.pending:
+                end_byte = self.pending.pop(self.offset)
+                await f.seek(self.offset)
+                while self.offset < end_byte:
+                    data = await f.read(min(WRITE_BUFFER_SIZE, end_byte - self.offset))
+                    if not data:
+                        return
+                    self.md5.update(data)
+                    self.offset += len(data)
+                self.HashBuffered()
+
+    async def GetDigest(self):
+        if self.catch_up:
+            await self.catch_up
+        await self.CatchUp()
+        
+        if self.offset != self.size:
+            print(f"DEBUG: Only {self.offset} of {self.size} bytes of \"{self.path}\" were hashed")
+            return None
+        return self.md5.hexdigest()
+
+class VerifiedIndex:
+    # Per-directory record of downloads whose MD5 matched (or did not match) Drive's md5Checksum, kept in
+    # VERIFIED_INDEX_DIR under a hash of the directory. A verified entry is only trusted while the local
+    # file keeps the size and mtime it was verified with.
+    def __init__(self, download_path):
+        self.folder = os.path.dirname(os.path.abspath(download_path))
+        folder_hash = hashlib.md5(os.path.normcase(self.folder).encode('utf-8')).hexdigest()
+        self.path = os.path.join(VERIFIED_INDEX_DIR, f"{folder_hash}.json")
+        self.name = os.path.basename(download_path)
+
+    def Load(self):
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def Record(self, file_id, md5, verified):
+        local_path = os.path.join(self.folder, self.name)
+        index = self.Load()
+        index[self.name] = {
+            'id': file_id,
+            'md5Checksum': md5,
+            'size': os.path.getsize(local_path),
+            'mtime': os.path.getmtime(local_path),
+            'state': 'verified' if verified else 'corrupt'
+        }
+        
+        os.makedirs(VERIFIED_INDEX_DIR, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.path)
+
+    def IsVerified(self, file_id, md5):
+        entry = self.Load().get(self.name)
+        local_path = os.path.join(self.folder, self.name)
+        
+        if not entry or not md5 or not os.path.isfile(local_path):
+            return False
+        
+        return entry['state'] == 'verified' \
+            and entry['id'] == file_id \
+            and entry['md5Checksum'] == md5 \
+            and entry['size'] == os.path.getsize(local_path) \
+            and entry['mtime'] == os.path.getmtime(local_path)
+
+#endregion
+
+#region Download Writer
+
+class DownloadWriter:
+    # Bytes go to a partial file next to the download path, so an existing copy (such as the previous
+    # version of a synced file) stays intact until the new one is complete and replaces it.
+    def __init__(self, path, size, md5=None):
+        self.path = path
+        self.partial_path = path + PARTIAL_EXTENSION
+        self.size = int(size)
+        self.md5 = md5
+        self.manifest = DownloadManifest(path)
+        self.hasher = StreamingHasher(self.partial_path, self.size) if md5 else None
+        self.digest = None
+        self.finished = False
+
+    async def Open(self, file_id, partitions):
+        if self.CanResume(file_id):
+            print(f"DEBUG: Resuming \"{self.path}\" ({self.manifest.GetBytesComplete()} of {self.size} bytes already downloaded)")
+            if self.hasher:
+                for start_byte, (_, written) in self.manifest.ranges.items():
+                    self.hasher.AddPending(start_byte, start_byte + written)
+            return self.manifest.GetMissingRanges()
+
+        await self.Preallocate()
+        self.manifest.Create(file_id, self.size, partitions)
+        return partitions
+
+    def CanResume(self, file_id):
+        if not self.manifest.Exists() or not os.path.isfile(self.partial_path):
+            return False
+        if not self.manifest.Load():
+            return False
+        return self.manifest.Matches(file_id, self.size) and os.path.getsize(self.partial_path) == self.size
+
+    async def Preallocate(self):
+        async with aiofiles.open(self.partial_path, "wb") as f:
+            await f.truncate(self.size)
+
+    def GetPath(self):
+        # Where the bytes currently are
+        return self.path if self.finished else self.partial_path
+
+    def GetBytesComplete(self):
+        return self.manifest.GetBytesComplete()
+
+    def GetResumeByte(self, start_byte):
+        return start_byte + self.manifest.GetWritten(start_byte)
+
+    def OpenRange(self, start_byte, end_byte):
+        return RangeWriter(self, start_byte, end_byte, self.manifest.GetWritten(start_byte))
+
+    async def Hash(self):
+        # Reads whatever the hasher still needs from the partial file, so it has to run before Finish
+        if self.hasher:
+            self.digest = await self.hasher.GetDigest()
+
+    def Finish(self):
+        # Returns False if the partial file could not replace the download path (e.g. the old copy is open
+        # in a player); the partial file and manifest are kept, so downloading again only has to replace it.
+        try:
+            os.replace(self.partial_path, self.path)
+        except OSError as err:
+            print(f"ERROR: Unable to move the finished download into \"{self.path}\": {err}")
+            return False
+        self.finished = True
+        self.manifest.Remove()
+        return True
+
+    def Verify(self, file_id):
+        # Returns None when Drive gave no md5Checksum (e.g. Google Docs), otherwise whether the file matched
+        if not self.hasher:
+            return None
+        
+        verified = self.digest == self.md5
+        print(f"DEBUG: MD5 of \"{self.path}\" is {self.digest}, expected {self.md5} ({'verified' if verified else 'CORRUPT'})")
+        
+        VerifiedIndex(self.path).Record(file_id, self.md5, verified)
+        return verified
+
+    def Close(self):
+        if self.hasher:
+            self.hasher.Close()
+
+    def Discard(self):
+        # Only the partial file and manifest belong to the download; the file at the download path is never touched
+        try:
+            if os.path.isfile(self.partial_path):
+                os.remove(self.partial_path)
+            self.manifest.Remove()
+        except OSError as err:
+            print(f"DEBUG: Unable to remove partial download \"{self.partial_path}\": {err}")
+
+class RangeWriter:
+    # Each range gets its own handle, so concurrent ranges never share a file position.
+    # Chunks are coalesced into a buffer of at most WRITE_BUFFER_SIZE bytes before each write,
+    # which keeps memory bounded per connection no matter how large the file is.
+    def __init__(self, writer : DownloadWriter, start_byte, end_byte, bytes_written=0):
+        self.writer = writer
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.bytes_written = bytes_written
+        self.buffer = bytearray()
+        self.f = None
+
+    async def __aenter__(self):
+        self.f = await aiofiles.open(self.writer.partial_path, "r+b")
+        await self.f.seek(self.start_byte + self.bytes_written)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.Flush()
+        finally:
+            await self.f.close()
+            self.writer.manifest.Update(self.start_byte, self.bytes_written, force=True)
+
+    def GetRemaining(self):
+        return (self.end_byte - self.start_byte) - self.bytes_written - len(self.buffer)
+
+    def IsComplete(self):
+        return self.bytes_written == self.end_byte - self.start_byte
+
+    async def Write(self, chunk):
+        remaining = self.GetRemaining()
+
+        if len(chunk) > remaining:
+            raise RangeResponseError(f"Received {len(chunk) - remaining} bytes past byte {self.end_byte - 1}")
+
+        self.buffer += chunk
+
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            await self.Flush()
+
+        return len(chunk)
+
+    async def Flush(self):
+        if self.buffer:
+            await self.f.write(self.buffer)
+            await self.f.flush()
+            if self.writer.hasher:
+                self.writer.hasher.Update(self.start_byte + self.bytes_written, self.buffer)
+            self.bytes_written += len(self.buffer)
+            self.buffer = bytearray()
+            self.writer.manifest.Update(self.start_byte, self.bytes_written)
+
+#endregion
+
+#region Adaptive Range Concurrency
+
+class AdaptiveRangeController:
+    # AIMD control of how many ranges are in flight at once. It starts at initial ranges, so files too
+    # small for many samples still download at full speed, and every ADAPTIVE_SAMPLE_INTERVAL seconds
+    # the aggregate throughput is compared with the best seen so far: a meaningful gain adds one range,
+    # a plateau holds, and a clear loss halves the number of ranges. A retried range also halves them
+    # and forgets the best throughput, so the controller probes upwards again once the link recovers.
+    # fetch_block retries each block itself, so a block that still fails fails the whole download.
+    def __init__(self, initial, minimum=ADAPTIVE_MIN_RANGES, maximum=ADAPTIVE_MAX_RANGES):
+        self.target = max(minimum, min(maximum, initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.best_throughput = 0
+        self.window_bytes = 0
+        self.window_start = monotonic()
+
+    def AddBytes(self, num_bytes):
+        self.window_bytes += num_bytes
+        elapsed = monotonic() - self.window_start
+        
+        if elapsed >= ADAPTIVE_SAMPLE_INTERVAL:
+            self.Evaluate(self.window_bytes / elapsed)
+            self.window_bytes = 0
+            self.window_start = monotonic()
+
+    def Evaluate(self, throughput):
+        if throughput > self.best_throughput * (1 + ADAPTIVE_GAIN_THRESHOLD):
+            self.best_throughput = throughput
+            self.target = min(self.maximum, self.target + 1)
+        elif throughput < self.best_throughput * (1 - ADAPTIVE_LOSS_THRESHOLD):
+            self.best_throughput = throughput
+            self.Decrease()
+            
+        print(f"DEBUG: Adaptive download at {throughput * 8 / 10**6:0.1f} Mbps, {self.target} concurrent ranges")
+
+    def Decrease(self):
+        self.target = max(self.minimum, self.target // 2)
+
+    def OnRetry(self):
+        self.best_throughput = 0
+        self.Decrease()
+
+    async def Run(self, blocks, fetch_block):
+        # fetch_block(start_byte, end_byte, on_chunk, on_retry) downloads one block, calling on_retry
+        # before each retry, and returns whether it completed
+        queue = deque(blocks)
+        active = {}
+        success = True
+        
+        try:
+            while queue or active:
+                while queue and len(active) < self.target:
+                    block = queue.popleft()
+                    active[asyncio.create_task(self.FetchBlock(fetch_block, *block))] = block
+                
+                done, _ = await asyncio.wait(active, return_when=asyncio.FIRST_COMPLETED)
+                
+                for task in done:
+                    block = active.pop(task)
+                    if not task.result():
+                        print(f"DEBUG: Block {block} failed, giving up")
+                        queue.clear()
+                        success = False
+        finally:
+            for task in active:
+                task.cancel()
+            if active:
+                await asyncio.gather(*active, return_exceptions=True)
+        
+        return success
+
+    async def FetchBlock(self, fetch_block, start_byte, end_byte):
+        start_time = monotonic()
+        
+        try:
+            success = await fetch_block(start_byte, end_byte, self.AddBytes, self.OnRetry)
+        except Exception as err:
+            print(f"DEBUG: Block {start_byte}-{end_byte} raised {err!r}")
+            return False
+        
+        duration = monotonic() - start_time
+        
+        if duration > 0:
+            print(f"DEBUG: Block {start_byte}-{end_byte} took {duration:0.2f}s ({(end_byte - start_byte) * 8 / duration / 10**6:0.1f} Mbps)")
+            
+        return success
+
+#endregion
+
+#region Download Scheduler
+
+class DownloadOrder(Enum):
+    LISTING = 0
+    SMALLEST_FIRST = 1
+
+class DownloadState(Enum):
+    QUEUED = "Queued"
+    ACTIVE = "Downloading"
+    PAUSED = "Paused"
+    CANCELLED = "Cancelled"
+    FAILED = "Failed"
+    DONE = "Done"
+
+class DownloadItem:
+    def __init__(self, file, download_path, index):
+        self.file = file
+        self.download_path = download_path
+        self.index = index
+        self.state = DownloadState.QUEUED
+        self.task = None
+        self.progress = None
+
+class ConnectionSlots:
+    # A semaphore whose waiters are served lowest priority first instead of in arrival order,
+    # so the range requests of the files at the front of the queue get the next free connection
+    def __init__(self, value):
+        self.value = value
+        self.waiters = []
+        self.num_waiters = 0
+
+    def ForPriority(self, priority):
+        return ConnectionSlot(self, priority)
+
+    async def Acquire(self, priority):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.num_waiters += 1
+        heapq.heappush(self.waiters, (priority, self.num_waiters, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # A slot handed over just as the waiter was cancelled goes to the next waiter
+            if future.done() and not future.cancelled():
+                self.Release()
+            raise
+
+    def Release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+class ConnectionSlot:
+    def __init__(self, slots : ConnectionSlots, priority):
+        self.slots = slots
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.slots.Acquire(self.priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.slots.Release()
+
+class DownloadScheduler:
+    # Runs a queue of file downloads with a global cap on open connections.
+    # download_item(item, connections) performs one download and returns whether it succeeded;
+    # it must hold connections (async with) for every request it has in flight, and report its
+    # bytes to item.progress. Connections go to the requests of the highest priority item first.
+    # Paused items keep their partial file and manifest, so resuming picks up where they stopped.
+    # Run() returns once only paused items are left. on_finish(item) is called whenever an item stops.
+    def __init__(self, download_item, max_connections, order=DownloadOrder.SMALLEST_FIRST, on_change=None, progress=None, on_finish=None):
+        self.download_item = download_item
+        self.max_connections = max_connections
+        self.order = order
+        self.on_change = on_change
+        self.on_finish = on_finish
+        self.progress = progress
+        self.connections = ConnectionSlots(max_connections)
+        self.items = []
+        self.queue = []
+        self.active = {}
+        self.adding = False
+        self.wakeup = asyncio.Event()
+
+    def GetPriority(self, item):
+        if self.order == DownloadOrder.SMALLEST_FIRST:
+            return (item.file.size, item.index)
+        return (item.index,)
+
+    def Add(self, file, download_path):
+        item = DownloadItem(file, download_path, len(self.items))
+        self.items.append(item)
+        self.Enqueue(item)
+        return item
+
+    def BeginAdding(self):
+        # Keeps Run() waiting for more items while a listing is still feeding the queue
+        self.adding = True
+
+    def FinishAdding(self):
+        self.adding = False
+        self.wakeup.set()
+
+    def Enqueue(self, item):
+        item.state = DownloadState.QUEUED
+        heapq.heappush(self.queue, (self.GetPriority(item), item.index, item))
+        self.wakeup.set()
+
+    def Pause(self, item):
+        if item.state == DownloadState.QUEUED:
+            item.state = DownloadState.PAUSED
+        elif item.state == DownloadState.ACTIVE:
+            item.state = DownloadState.PAUSED
+            item.task.cancel()
+        self.Changed()
+
+    def Resume(self, item):
+        if item.state in [DownloadState.PAUSED, DownloadState.FAILED]:
+            self.Enqueue(item)
+            self.Changed()
+
+    def Cancel(self, item):
+        if item.state == DownloadState.ACTIVE:
+            item.state = DownloadState.CANCELLED
+            item.task.cancel()
+        elif item.state in [DownloadState.QUEUED, DownloadState.PAUSED, DownloadState.FAILED]:
+            item.state = DownloadState.CANCELLED
+            self.Discard(item)
+            self.wakeup.set()
+        self.Changed()
+
+    def Discard(self, item):
+        DownloadWriter(item.download_path, item.file.size).Discard()
+        if self.progress:
+            self.progress.RemoveTotal(item.file.size)
+
+    def Changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+    def GetPausedItems(self):
+        return [item for item in self.items if item.state == DownloadState.PAUSED]
+
+    def Start(self, item):
+        item.state = DownloadState.ACTIVE
+        item.progress = ItemProgress(self.progress) if self.progress else None
+        item.task = asyncio.create_task(self.download_item(item, self.connections.ForPriority((self.GetPriority(item), item.index))))
+        self.active[item.task] = item
+        self.Changed()
+
+    def Finished(self, task):
+        item = self.active.pop(task)
+        
+        if item.state == DownloadState.ACTIVE:
+            if task.cancelled():
+                item.state = DownloadState.FAILED
+            elif task.exception():
+                print(f"DEBUG: Download of \"{item.file.name}\" raised {task.exception()!r}")
+                item.state = DownloadState.FAILED
+            else:
+                item.state = DownloadState.DONE if task.result() else DownloadState.FAILED
+        
+        if item.state != DownloadState.DONE and item.progress:
+            # Paused and failed files count their bytes again when restarted, and cancelled ones not at all
+            item.progress.Remove()
+        if item.state == DownloadState.CANCELLED:
+            self.Discard(item)
+        if self.on_finish:
+            self.on_finish(item)
+        
+        self.Changed()
+
+    async def Run(self):
+        while True:
+            while self.queue and len(self.active) < self.max_connections:
+                _, _, item = heapq.heappop(self.queue)
+                if item.state == DownloadState.QUEUED:
+                    self.Start(item)
+            
+            if not self.active and not self.queue and not self.adding:
+                break
+            
+            self.wakeup.clear()
+            waiter = asyncio.create_task(self.wakeup.wait())
+            done, _ = await asyncio.wait([*self.active, waiter], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            
+            for task in done:
+                if task in self.active:
+                    self.Finished(task)
+        
+        return all(item.state in [DownloadState.DONE, DownloadState.CANCELLED] for item in self.items)
+
+#endregion
+
+#region Progress Reporting
+
+class ProgressAggregator:
+    # Download tasks only bump plain integer counters; Run() pushes a snapshot to on_update
+    # every PROGRESS_UPDATE_INTERVAL seconds, so the UI never sees per-chunk updates.
+    def __init__(self, total_bytes):
+        self.total_bytes = int(total_bytes)
+        self.done_bytes = 0
+        self.transferred_bytes = 0
+        self.start_time = monotonic()
+        self.samples = deque([(self.start_time, 0)])
+        self.running = False
+
+    def AddBytes(self, num_bytes):
+        self.done_bytes += num_bytes
+        self.transferred_bytes += num_bytes
+
+    def AddCompleted(self, num_bytes):
+        # Bytes already on disk (resumed or verified) count towards progress but not speed
+        self.done_bytes += num_bytes
+
+    def RemoveCompleted(self, num_bytes):
+        self.done_bytes -= num_bytes
+
+    def AddTotal(self, num_bytes):
+        self.total_bytes += num_bytes
+
+    def RemoveTotal(self, num_bytes):
+        self.total_bytes -= num_bytes
+
+    def GetFraction(self):
+        # A folder's total is unknown until its listing adds files
+        if self.total_bytes <= 0:
+            return 0
+        return min(1, self.done_bytes / self.total_bytes)
+
+    def GetScaledValue(self, scale=PROGRESS_SCALE):
+        return round(self.GetFraction() * scale)
+
+    def Sample(self):
+        now = monotonic()
+        self.samples.append((now, self.transferred_bytes))
+        while len(self.samples) > 2 and now - self.samples[0][0] > PROGRESS_SPEED_WINDOW:
+            self.samples.popleft()
+
+    def GetSpeed(self):
+        (start_time, start_bytes), (end_time, end_bytes) = self.samples[0], self.samples[-1]
+        if end_time <= start_time:
+            return 0
+        return (end_bytes - start_bytes) / (end_time - start_time)
+
+    def GetETA(self):
+        speed = self.GetSpeed()
+        if speed <= 0:
+            return None
+        return max(0, self.total_bytes - self.done_bytes) / speed
+
+    def FormatStatus(self):
+        eta = self.GetETA()
+        eta_string = "--:--" if eta is None else FormatDuration(eta)
+        return f"{self.GetFraction() * 100:0.1f}% - {self.GetSpeed() / 2**20:0.1f} MB/s - ETA {eta_string}"
+
+    async def Run(self, on_update, interval=PROGRESS_UPDATE_INTERVAL):
+        self.running = True
+        while self.running:
+            self.Sample()
+            on_update(self)
+            await asyncio.sleep(interval)
+        self.Sample()
+        on_update(self)
+
+    def Stop(self):
+        self.running = False
+
+class ItemProgress:
+    # One file's share of a ProgressAggregator, so it can be taken back out if the file doesn't finish
+    def __init__(self, progress : ProgressAggregator):
+        self.progress = progress
+        self.done_bytes = 0
+
+    def AddBytes(self, num_bytes):
+        self.done_bytes += num_bytes
+        self.progress.AddBytes(num_bytes)
+
+    def AddCompleted(self, num_bytes):
+        self.done_bytes += num_bytes
+        self.progress.AddCompleted(num_bytes)
+
+    def Remove(self):
+        self.progress.RemoveCompleted(self.done_bytes)
+        self.done_bytes = 0
+
+def FormatDuration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
+#endregion
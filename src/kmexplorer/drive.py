@@ -0,0 +1,174 @@
+"""
+Shared connection pool and request error handling for Google Drive traffic
+"""
+import os
+import random
+import asyncio
+import aiohttp
+import weakref
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Overridable so benchmarks can point every Drive request at a local stand-in server
+DRIVE_FILES_URL = os.environ.get("KMEXPLORER_DRIVE_FILES_URL", "https://www.googleapis.com/drive/v3/files")
+DRIVE_CHANGES_URL = DRIVE_FILES_URL.rsplit('/', 1)[0] + "/changes"
+DRIVE_BATCH_URL = os.environ.get("KMEXPLORER_DRIVE_BATCH_URL", "https://www.googleapis.com/batch/drive/v3")
+DRIVE_FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+GOOGLE_APPS_MIME_PREFIX = "application/vnd.google-apps."
+
+MIN_CHUNK_SIZE = 2**18
+
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 32
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+
+MAX_RANGE_RETRIES = 6
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 64
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+class DriveSession:
+    # One long-lived aiohttp session (and TCP/TLS connection pool) for every Drive request.
+    # The session is created lazily so it is bound to the event loop that first uses it.
+    def __init__(self, limit=POOL_LIMIT, limit_per_host=POOL_LIMIT_PER_HOST, dns_cache_ttl=DNS_CACHE_TTL, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+    def IsOpen(self):
+        return self.session is not None and not self.session.closed
+
+    def GetSession(self):
+        if not self.IsOpen():
+            print(f"DEBUG: Opening Drive connection pool (limit={self.limit}, limit_per_host={self.limit_per_host})")
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            # Large ranges can take far longer than aiohttp's default 5 minute total timeout,
+            # so only connecting and individual socket reads are bounded.
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, read_bufsize=MIN_CHUNK_SIZE)
+        return self.session
+
+    async def Close(self):
+        if self.IsOpen():
+            print("DEBUG: Closing Drive connection pool")
+            await self.session.close()
+        self.session = None
+
+def IsDownloadableMimeType(mime_type):
+    # Google Docs, Sheets, shortcuts and folders have no binary content to download
+    return not mime_type.startswith(GOOGLE_APPS_MIME_PREFIX)
+
+async def GetDriveJSON(drive_session : DriveSession, token, url, params):
+    async with drive_session.GetSession().get(url, params=params, headers=token.GetHeaders()) as resp:
+        if resp.status != 200:
+            raise DriveRequestError(resp.status, await resp.text(), resp.headers.get("Retry-After"))
+        return await resp.json()
+
+def GetDriveMediaURL(file_id, api_key=None):
+    if api_key:
+        return f"{DRIVE_FILES_URL}/{file_id}?alt=media&key={api_key}"
+    return f"{DRIVE_FILES_URL}/{file_id}?alt=media"
+
+class DriveToken:
+    # Bearer token for Drive requests. When backed by a pydrive2 GoogleAuth it can be refreshed,
+    # and concurrent refreshes of the same expired token collapse into one. The UI loop and the
+    # streaming proxy's loop share one token, so the refresh runs on an executor thread behind a
+    # thread lock, and each loop's callers wait on that loop's own pending refresh.
+    def __init__(self, gauth=None, credentials_path=None, access_token=None):
+        self.gauth = gauth
+        self.credentials_path = credentials_path
+        self.access_token = access_token if access_token else gauth.credentials.access_token
+        self.lock = threading.Lock()
+        self.refreshing = weakref.WeakKeyDictionary()
+
+    def Get(self):
+        return self.access_token
+
+    def SetCredentials(self, gauth):
+        # Signing in again updates the token that downloads and the streaming proxy already hold
+        with self.lock:
+            self.gauth = gauth
+            self.access_token = gauth.credentials.access_token
+
+    def GetHeaders(self):
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+    async def Refresh(self, expired_token):
+        loop = asyncio.get_running_loop()
+        pending = self.refreshing.get(loop)
+        if pending is None or pending.done():
+            pending = loop.run_in_executor(None, self.RefreshBlocking, expired_token)
+            self.refreshing[loop] = pending
+        return await asyncio.shield(pending)
+
+    def RefreshBlocking(self, expired_token):
+        with self.lock:
+            if self.access_token != expired_token:
+                return True
+            if not self.gauth:
+                print("DEBUG: Access token expired and cannot be refreshed")
+                return False
+            
+            print("DEBUG: Refreshing Google Access Token")
+            try:
+                self.gauth.Refresh()
+                if self.credentials_path:
+                    self.gauth.SaveCredentialsFile(self.credentials_path)
+            except Exception as err:
+                print(f"DEBUG: Unable to refresh Google access token: {err}")
+                return False
+            
+            self.access_token = self.gauth.credentials.access_token
+            return True
+
+class DriveRequestError(Exception):
+    def __init__(self, status, message='', retry_after=None):
+        super().__init__(f"Drive request failed with status {status}: {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = ParseRetryAfter(retry_after)
+
+    def IsAuthError(self):
+        return self.status == 401
+
+    def IsRateLimited(self):
+        return self.status == 429 or (self.status == 403 and any(reason in self.message for reason in RATE_LIMIT_REASONS))
+
+    def IsRetryable(self):
+        return self.status in RETRYABLE_STATUSES or self.IsRateLimited()
+
+def ParseRetryAfter(retry_after):
+    if not retry_after:
+        return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    # Exponential backoff with full jitter, unless the server told us how long to wait
+    def __init__(self, max_retries=MAX_RANGE_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def GetDelay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
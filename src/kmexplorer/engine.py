@@ -0,0 +1,343 @@
+"""
+Google Drive download engine shared by the app and the command line
+"""
+import os
+import re
+import asyncio
+import aiohttp
+from time import monotonic
+from kmexplorer.download import DownloadWriter, VerifiedIndex, RangePlanner, RangeResponseError, AdaptiveRangeController, DownloadScheduler, DownloadOrder, ProgressAggregator, ADAPTIVE_BLOCK_SIZE
+from kmexplorer.telemetry import Telemetry, TelemetryJob, TransferMetrics
+from kmexplorer.limiter import BandwidthLimiter
+from kmexplorer.drive import DriveSession, DriveToken, DriveRequestError, RetryPolicy, GetDriveMediaURL, IsDownloadableMimeType, DRIVE_FOLDER_MIME_TYPE, MIN_CHUNK_SIZE
+from kmexplorer.client import DriveClient
+
+# Each partial download is limited to 20 mbps and my internet speed is 250 mbps,
+# so I chose NUM_DL_PARTS = 12 because 12 * 20 mbps = 240 mbps.
+# With ADAPTIVE_DOWNLOADS, downloads start with NUM_DL_PARTS ranges and tune the number while downloading.
+NUM_DL_PARTS = 12
+ADAPTIVE_DOWNLOADS = True
+MAX_DL_CONNECTIONS = NUM_DL_PARTS
+
+WALK_MAX_LISTINGS = 8
+INVALID_NAME_CHARACTERS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+class File:
+    def __init__(self, id, name, size=None, md5=None, modified=None):
+        self.id = id
+        self.name = name
+        self.size = int(size)
+        self.md5 = md5
+        self.modified = modified
+
+    def GetSizeMB(self):
+        return round(self.size / 2**20, 2)
+
+    def CreatePartitions(self, num_parts):
+        return RangePlanner(self.size).CreatePartitions(num_parts)
+
+    def CreateBlocks(self, block_size):
+        return RangePlanner(self.size).CreateBlocks(block_size)
+
+def GetDriveFile(metadata):
+    # Drive v3 metadata (see DRIVE_FILE_FIELDS) to a File
+    return File(metadata['id'], metadata['name'], metadata.get('size', 0), metadata.get('md5Checksum'), metadata.get('modifiedTime'))
+
+def GetLocalFileName(name):
+    # Drive allows names Windows does not
+    name = INVALID_NAME_CHARACTERS.sub('_', name).rstrip('. ')
+    return name if name else '_'
+
+class DownloadPathPlanner:
+    # Maps Drive files to paths under download_folder, recreating the folder structure.
+    # Drive allows several files with the same name in one folder, so repeats get a " (n)" suffix.
+    def __init__(self, download_folder):
+        self.download_folder = download_folder
+        self.used_paths = set()
+
+    def GetPath(self, relative_dir, name):
+        folder = os.path.join(self.download_folder, relative_dir)
+        os.makedirs(folder, exist_ok=True)
+
+        stem, extension = os.path.splitext(GetLocalFileName(name))
+        path = os.path.join(folder, stem + extension)
+        copy = 1
+        while os.path.normcase(path) in self.used_paths:
+            path = os.path.join(folder, f"{stem} ({copy}){extension}")
+            copy += 1
+
+        self.used_paths.add(os.path.normcase(path))
+        return path
+
+class FolderWalker:
+    # Lists a Drive folder tree with up to max_listings folders in flight at once. Each page of
+    # downloadable files is handed to on_files(files, relative_dir) as soon as it arrives, so
+    # downloads start long before a deep tree has been fully crawled.
+    def __init__(self, drive_session : DriveSession, token : DriveToken, retry_policy=None, max_listings=WALK_MAX_LISTINGS):
+        self.client = DriveClient(drive_session, token, retry_policy)
+        self.max_listings = max_listings
+        self.num_folders = 0
+        self.num_files = 0
+        self.num_skipped = 0
+        self.failed_folders = []
+        self.errors = {}
+        self.visited = set()
+
+    async def Walk(self, folder_id, on_files, recursive=True):
+        # Returns whether every folder could be listed
+        folders = asyncio.Queue()
+        self.Enqueue(folders, folder_id, '')
+
+        workers = [asyncio.ensure_future(self.RunWorker(folders, on_files, recursive)) for _ in range(self.max_listings)]
+        try:
+            await folders.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        print(f"DEBUG: Listed {self.num_files} files in {self.num_folders} folders ({self.num_skipped} skipped, {len(self.failed_folders)} failed)")
+        return not self.failed_folders
+
+    def Enqueue(self, folders : asyncio.Queue, folder_id, relative_dir):
+        # A folder can have several parents, so it is only listed the first time it turns up
+        if folder_id in self.visited:
+            return
+        self.visited.add(folder_id)
+        folders.put_nowait((folder_id, relative_dir))
+
+    async def RunWorker(self, folders : asyncio.Queue, on_files, recursive):
+        while True:
+            folder_id, relative_dir = await folders.get()
+            self.num_folders += 1
+
+            try:
+                async for page in self.client.ListFolder(folder_id):
+                    files = []
+                    for metadata in page:
+                        if metadata['mimeType'] == DRIVE_FOLDER_MIME_TYPE:
+                            if recursive:
+                                self.Enqueue(folders, metadata['id'], os.path.join(relative_dir, GetLocalFileName(metadata['name'])))
+                        elif IsDownloadableMimeType(metadata['mimeType']):
+                            files.append(metadata)
+                        else:
+                            self.num_skipped += 1
+
+                    self.num_files += len(files)
+                    if files:
+                        on_files(files, relative_dir)
+
+            except Exception as err:
+                # Errors from on_files (such as a download folder that can't be created) only fail this folder too;
+                # a worker that died here would leave the queue unfinished and Walk waiting forever
+                print(f"ERROR: Unable to list Drive folder \"{folder_id}\" ({relative_dir or '.'}): {err!r}")
+                self.failed_folders.append(folder_id)
+                self.errors[folder_id] = err
+
+            finally:
+                folders.task_done()
+
+class DownloadEngine:
+    # Everything needed to download Drive files, without any UI. Failures are reported
+    # through on_error(title, message) so the app can show a dialog and the CLI can print them.
+    def __init__(self, drive_session : DriveSession, token : DriveToken = None, api_key=None, retry_policy=None, on_error=None, telemetry : Telemetry = None, limiter : BandwidthLimiter = None):
+        self.drive_session = drive_session
+        self.token = token
+        self.api_key = api_key
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.on_error = on_error
+        self.telemetry = telemetry
+        self.limiter = limiter
+
+    def ReportError(self, title, message):
+        print(f"ERROR: {title}: {message}")
+        if self.on_error:
+            self.on_error(title, message)
+
+    def CreateScheduler(self, progress : ProgressAggregator = None, order=DownloadOrder.SMALLEST_FIRST, max_connections=MAX_DL_CONNECTIONS, num_parts=NUM_DL_PARTS, on_change=None, adaptive=ADAPTIVE_DOWNLOADS, on_finish=None, job : TelemetryJob = None):
+        # Every range request across all files shares max_connections connection slots; with job, their telemetry is exported together
+        return DownloadScheduler(
+            lambda item, connections: self.DownloadFile(item.file, item.download_path, item.progress, num_parts, adaptive, connections, job),
+            max_connections,
+            order,
+            on_change=on_change,
+            progress=progress,
+            on_finish=on_finish
+        )
+
+    async def DownloadPart(self, file : File, writer : DownloadWriter, progress : ProgressAggregator, start_byte, end_byte, on_chunk=None, partitioned=True, connections : asyncio.Semaphore = None, metrics : TransferMetrics = None, on_retry=None):
+        # Retries only this range; FetchFile resumes from the last byte the manifest has on disk
+        client = self.drive_session.GetSession()
+        attempt = 0
+
+        while True:
+            token = self.token.Get()
+            retry_after = None
+            rate_limited = False
+            range_metrics = metrics.StartRange(writer.GetResumeByte(start_byte), end_byte, attempt) if metrics else None
+
+            try:
+                if connections:
+                    async with connections:
+                        success = await self.FetchFile(client, file, writer, progress, partitioned=partitioned, start_byte=start_byte, end_byte=end_byte, on_chunk=on_chunk, range_metrics=range_metrics)
+                else:
+                    success = await self.FetchFile(client, file, writer, progress, partitioned=partitioned, start_byte=start_byte, end_byte=end_byte, on_chunk=on_chunk, range_metrics=range_metrics)
+
+                if success:
+                    if range_metrics:
+                        range_metrics.Finish()
+                    return True
+                reason = "response ended early"
+
+            except DriveRequestError as err:
+                if err.IsAuthError():
+                    if range_metrics:
+                        range_metrics.Finish("access token expired")
+                    if not await self.token.Refresh(token):
+                        return False
+                    reason = "access token expired"
+                elif err.IsRetryable():
+                    retry_after = err.retry_after
+                    rate_limited = err.IsRateLimited()
+                    reason = f"status {err.status}"
+                else:
+                    if range_metrics:
+                        range_metrics.Finish(f"status {err.status}")
+                    return False
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, RangeResponseError) as err:
+                reason = repr(err)
+
+            if range_metrics and range_metrics.duration is None:
+                range_metrics.Finish(reason)
+
+            if attempt >= self.retry_policy.max_retries:
+                print(f"ERROR: Giving up on \"{file.name}\" bytes {start_byte}-{end_byte} after {attempt + 1} attempts ({reason})")
+                return False
+
+            if metrics:
+                metrics.AddRetry(rate_limited)
+            if on_retry:
+                on_retry()
+
+            delay = self.retry_policy.GetDelay(attempt, retry_after)
+            print(f"DEBUG: Retrying \"{file.name}\" bytes {writer.GetResumeByte(start_byte)}-{end_byte} in {delay:0.1f}s ({reason})")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def DownloadFile(self, file : File, download_path, progress : ProgressAggregator = None, num_parts=None, adaptive=False, connections : asyncio.Semaphore = None, job : TelemetryJob = None):
+        if VerifiedIndex(download_path).IsVerified(file.id, file.md5):
+            print(f"DEBUG: \"{download_path}\" was already downloaded and verified, skipping download")
+            if progress:
+                progress.AddCompleted(file.size)
+            return True
+
+        writer = DownloadWriter(download_path, file.size, file.md5)
+        metrics = self.telemetry.StartTransfer(file, job) if self.telemetry else None
+        success = False
+        try:
+            success = await self.TransferFile(file, writer, progress, num_parts, adaptive, connections, metrics)
+        finally:
+            writer.Close()
+            if metrics:
+                self.telemetry.FinishTransfer(metrics, success)
+        return success
+
+    async def TransferFile(self, file : File, writer : DownloadWriter, progress : ProgressAggregator, num_parts, adaptive, connections : asyncio.Semaphore, metrics : TransferMetrics):
+        partitioned = bool(num_parts) and file.size >= (MIN_CHUNK_SIZE*100)
+
+        if partitioned and adaptive:
+            partitions = file.CreateBlocks(ADAPTIVE_BLOCK_SIZE)
+        elif partitioned:
+            partitions = file.CreatePartitions(num_parts)
+        else:
+            partitions = [(0, file.size)]
+
+        missing_ranges = await writer.Open(file.id, partitions)
+
+        if progress:
+            progress.AddCompleted(writer.GetBytesComplete())
+
+        if partitioned and adaptive:
+            controller = AdaptiveRangeController(num_parts)
+            success = await controller.Run(missing_ranges, lambda start_byte, end_byte, on_chunk, on_retry: self.DownloadPart(file, writer, progress, start_byte, end_byte, on_chunk, connections=connections, metrics=metrics, on_retry=on_retry))
+
+        elif partitioned:
+            results = await asyncio.gather(*map(lambda part: self.DownloadPart(file, writer, progress, part[0], part[1], connections=connections, metrics=metrics), missing_ranges))
+            success = all(results)
+
+        else:
+            success = all([await self.DownloadPart(file, writer, progress, start_byte, end_byte, partitioned=False, connections=connections, metrics=metrics) for start_byte, end_byte in missing_ranges])
+
+        if not success:
+            self.ReportError(
+                "Download Failed",
+                f"Failed to download \"{file.name}\". Please try again later.\n\nDownloading to the same location again will resume where this download left off."
+            )
+            return False
+
+        await writer.Hash()
+
+        if not writer.Finish():
+            self.ReportError(
+                "Download Failed",
+                f"Unable to replace \"{writer.path}\" with the finished download of \"{file.name}\". Please close any program using it and try again."
+            )
+            return False
+
+        if writer.Verify(file.id) == False:
+            self.ReportError(
+                "Download Corrupt",
+                f"\"{file.name}\" did not match the checksum reported by Google Drive and may be corrupt.\n\nPlease download it again."
+            )
+            return False
+
+        print(f"\nFinished Downloading \"{file.name}\"!\n")
+        return True
+
+    async def FetchFile(self, client : aiohttp.ClientSession, file : File, writer : DownloadWriter, progress : ProgressAggregator = None, partitioned=False, start_byte=0, end_byte=None, on_chunk=None, range_metrics=None):
+        headers = {**self.token.GetHeaders(),
+                   "Accept": "application/json"}
+        params = {"supportsAllDrives": "true"}
+
+        planner = RangePlanner(file.size)
+        resume_byte = writer.GetResumeByte(start_byte)
+        requested_range = partitioned or resume_byte > start_byte
+        download_string = f"Downloading \"{file.name}\""
+
+        if requested_range:
+            headers["Range"] = planner.GetRangeHeader(resume_byte, end_byte)
+            download_string += f" from byte {resume_byte} to {end_byte - 1} ({end_byte - resume_byte} bytes)"
+
+        print(download_string)
+
+        async with client.get(GetDriveMediaURL(file.id, self.api_key), params=params, headers=headers) as resp:
+            if range_metrics:
+                range_metrics.FirstByte(resp.status)
+
+            if resp.status in [200, 206]:
+                planner.ValidateResponse(resp.status, resp.headers, resume_byte, end_byte, requested_range)
+
+                async with writer.OpenRange(start_byte, end_byte) as range_writer:
+                    async for chunk, _ in resp.content.iter_chunks():
+                        if self.limiter:
+                            # Not reading while the limit is exceeded lets TCP flow control slow the sender down
+                            await self.limiter.Acquire(len(chunk))
+                        if range_metrics:
+                            write_start = monotonic()
+                            await range_writer.Write(chunk)
+                            range_metrics.write_seconds += monotonic() - write_start
+                            range_metrics.bytes += len(chunk)
+                        else:
+                            await range_writer.Write(chunk)
+                        if on_chunk:
+                            on_chunk(len(chunk))
+                        if progress:
+                            progress.AddBytes(len(chunk))
+
+                print(f"\nDownloaded {range_writer.bytes_written}, Expected {end_byte - start_byte}")
+                return range_writer.IsComplete()
+
+            else:
+                message = await resp.text()
+                print(f"ERROR: Ecountered an error while {download_string}\nResponse Status: {resp.status}\nResponse Content: {message}")
+                raise DriveRequestError(resp.status, message, resp.headers.get("Retry-After"))
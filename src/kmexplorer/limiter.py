@@ -0,0 +1,107 @@
+"""
+Token bucket bandwidth limit shared by every download range and the streaming proxy
+"""
+import asyncio
+import threading
+from time import monotonic
+from datetime import datetime
+
+MB = 2**20
+LIMITER_BURST_SECONDS = 0.25
+LIMITER_MAX_WAIT = 0.5
+
+class BandwidthWindow:
+    # A daily time of day window ("HH:MM" local time) with its own limit in MB/s, None for unlimited.
+    # A window whose end is before its start runs past midnight.
+    def __init__(self, start, end, mb_per_second):
+        self.start = ParseTimeOfDay(start)
+        self.end = ParseTimeOfDay(end)
+        self.mb_per_second = mb_per_second
+
+    def Contains(self, minute):
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+    def __repr__(self):
+        return f"{FormatTimeOfDay(self.start)}-{FormatTimeOfDay(self.end)}={self.mb_per_second}"
+
+class BandwidthLimiter:
+    # Every received chunk is paid for with Acquire(). The bucket holds at most LIMITER_BURST_SECONDS
+    # of bytes, so concurrent ranges share the limit evenly instead of taking turns in bursts.
+    # A chunk may overdraw the bucket; later callers wait until it is paid back.
+    # The proxy reads on its own thread and loop, so the bucket is guarded by a thread lock that is
+    # never held across an await, and waits are capped at LIMITER_MAX_WAIT to pick up limit changes.
+    def __init__(self, mb_per_second=None, schedule=None):
+        self.mb_per_second = mb_per_second
+        self.schedule = list(schedule) if schedule else []
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.last_time = monotonic()
+
+    def SetLimit(self, mb_per_second):
+        # None or 0 removes the limit outside the scheduled windows
+        with self.lock:
+            self.Refill()
+            self.mb_per_second = mb_per_second if mb_per_second else None
+        print(f"DEBUG: Bandwidth limit set to {self.mb_per_second or 'unlimited'} MB/s")
+
+    def SetSchedule(self, schedule):
+        with self.lock:
+            self.Refill()
+            self.schedule = list(schedule) if schedule else []
+
+    def GetLimit(self, now=None):
+        # The limit in MB/s right now: the first scheduled window containing the time of day, else the base limit
+        now = now if now else datetime.now()
+        minute = now.hour * 60 + now.minute
+        for window in self.schedule:
+            if window.Contains(minute):
+                return window.mb_per_second if window.mb_per_second else None
+        return self.mb_per_second
+
+    def GetRate(self):
+        limit = self.GetLimit()
+        return limit * MB if limit else None
+
+    def IsLimited(self):
+        return self.GetRate() is not None
+
+    def Refill(self):
+        rate = self.GetRate()
+        now = monotonic()
+        if rate is None:
+            self.tokens = 0
+        else:
+            self.tokens = min(self.tokens + (now - self.last_time) * rate, rate * LIMITER_BURST_SECONDS)
+        self.last_time = now
+        return rate
+
+    async def Acquire(self, num_bytes):
+        while True:
+            with self.lock:
+                rate = self.Refill()
+                if rate is None:
+                    return
+                if self.tokens >= 0:
+                    self.tokens -= num_bytes
+                    return
+                wait = -self.tokens / rate
+            await asyncio.sleep(min(wait, LIMITER_MAX_WAIT))
+
+def ParseTimeOfDay(value):
+    hours, minutes = value.split(':')
+    if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+        raise ValueError(f"Invalid time of day: {value}")
+    return int(hours) * 60 + int(minutes)
+
+def FormatTimeOfDay(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def ParseBandwidthWindow(value):
+    # "09:00-17:00=2" limits downloads to 2 MB/s between 9am and 5pm; "=0" is unlimited
+    times, _, limit = value.partition('=')
+    start, _, end = times.partition('-')
+    if not limit or not end:
+        raise ValueError(f"Expected HH:MM-HH:MM=MB/s, got \"{value}\"")
+    return BandwidthWindow(start.strip(), end.strip(), float(limit) or None)
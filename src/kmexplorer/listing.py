@@ -0,0 +1,220 @@
+"""
+Persistent cache of Drive folder listings, kept current with the changes.list feed
+"""
+import os
+import re
+import json
+import asyncio
+import aiohttp
+from time import time, monotonic
+from kmexplorer.drive import DriveRequestError, DRIVE_FOLDER_MIME_TYPE
+from kmexplorer.client import DriveClient
+
+LISTING_CACHE_MAX_FOLDERS = 500
+LISTING_CACHE_MAX_AGE = 24 * 60 * 60
+LISTING_CHANGES_INTERVAL = 15
+# Folders first, then names with numbers in numeric order, as the table shows them
+LISTING_ORDER = "folder,name_natural"
+# changes.list answers an invalid or expired page token with one of these
+INVALID_PAGE_TOKEN_STATUSES = {400, 404, 410}
+
+class FolderListingCache:
+    # Folder listings keyed by folder id, saved to path between sessions. Instead of relisting, at most
+    # every LISTING_CHANGES_INTERVAL seconds one changes.list call applies every add, rename, move and
+    # delete since the last one to the cached listings. Files shared with the user that are not in
+    # their Drive may be missing from the feed, so listings are also relisted after LISTING_CACHE_MAX_AGE.
+    # The file is read and written on an executor thread, and only written when something changed.
+    def __init__(self, path, client : DriveClient, max_folders=LISTING_CACHE_MAX_FOLDERS, max_age=LISTING_CACHE_MAX_AGE):
+        self.path = path
+        self.client = client
+        self.max_folders = max_folders
+        self.max_age = max_age
+        self.state = None
+        self.locations = {}
+        self.dirty = False
+        self.last_update = None
+        self.lock = None
+
+    #region State
+
+    def Load(self):
+        if self.state is None:
+            try:
+                with open(self.path, "r", encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {'page_token': None, 'folders': {}}
+            self.IndexFolders()
+        return self.state
+
+    def IndexFolders(self):
+        # locations[file_id] holds every cached folder listing file_id, so a change only touches those folders
+        self.locations = {}
+        for folder_id, entry in self.state['folders'].items():
+            for metadata in entry['files']:
+                self.locations.setdefault(metadata['id'], set()).add(folder_id)
+
+    async def Save(self):
+        # Called with the lock held, so nothing changes the state while it is written
+        if not self.dirty:
+            return
+        self.dirty = False
+        await asyncio.get_running_loop().run_in_executor(None, self.Write)
+
+    def Write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+
+    def GetCached(self, folder_id):
+        entry = self.Load()['folders'].get(folder_id)
+        if entry is None or time() - entry['listed'] > self.max_age:
+            return None
+        entry['used'] = time()
+        return entry['files']
+
+    def Store(self, folder_id, files):
+        folders = self.Load()['folders']
+        self.RemoveFolder(folder_id)
+        folders[folder_id] = {'files': files, 'listed': time(), 'used': time()}
+        for metadata in files:
+            self.locations.setdefault(metadata['id'], set()).add(folder_id)
+
+        for stale_id in sorted(folders, key=lambda key: folders[key]['used'])[:max(0, len(folders) - self.max_folders)]:
+            self.RemoveFolder(stale_id)
+        self.dirty = True
+
+    def RemoveFolder(self, folder_id):
+        entry = self.Load()['folders'].pop(folder_id, None)
+        if entry is None:
+            return
+        for metadata in entry['files']:
+            locations = self.locations.get(metadata['id'])
+            if locations:
+                locations.discard(folder_id)
+                if not locations:
+                    del self.locations[metadata['id']]
+        self.dirty = True
+
+    def Invalidate(self, folder_id=None):
+        # Saved along with the next listing
+        if folder_id is None:
+            self.Load()['folders'].clear()
+            self.locations = {}
+        else:
+            self.RemoveFolder(folder_id)
+        self.dirty = True
+
+    #endregion
+
+    #region Listing
+
+    async def List(self, folder_id, refresh=False, on_page=None):
+        # Returns the metadata of every file and folder in folder_id, sorted by LISTING_ORDER.
+        # on_page(files) is called with each page as it arrives, or once with a cached listing.
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            await asyncio.get_running_loop().run_in_executor(None, self.Load)
+            await self.Update()
+
+            files = None if refresh else self.GetCached(folder_id)
+            if files is not None:
+                print(f"DEBUG: Listing of \"{folder_id}\" came from the listing cache")
+                if on_page:
+                    on_page(files)
+                return files
+
+            files = []
+            async for page in self.client.ListFolder(folder_id, LISTING_ORDER):
+                files += page
+                if on_page:
+                    on_page(page)
+
+            self.Store(folder_id, files)
+            await self.Save()
+            return files
+
+    #endregion
+
+    #region Changes
+
+    async def Update(self):
+        if self.last_update is not None and monotonic() - self.last_update < LISTING_CHANGES_INTERVAL:
+            return
+        self.last_update = monotonic()
+        state = self.Load()
+
+        try:
+            if not state['page_token']:
+                # Nothing says what changed before the feed starts, so older listings can't be trusted
+                state['page_token'] = await self.client.GetStartPageToken()
+                self.Invalidate()
+                await self.Save()
+                return
+
+            num_changes = await self.ApplyChanges(state)
+            if num_changes:
+                print(f"DEBUG: Applied {num_changes} Drive changes to the listing cache")
+            await self.Save()
+
+        except DriveRequestError as err:
+            if err.status not in INVALID_PAGE_TOKEN_STATUSES:
+                print(f"DEBUG: Unable to read Drive changes, using cached listings as they are: {err}")
+                return
+            # An expired or invalid page token; start over from a fresh one
+            print(f"DEBUG: Unable to read Drive changes, clearing the listing cache: {err}")
+            state['page_token'] = None
+            self.Invalidate()
+            await self.Save()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            print(f"DEBUG: Unable to read Drive changes, using cached listings as they are: {err!r}")
+
+    async def ApplyChanges(self, state):
+        num_changes = 0
+        async for page in self.client.ListChanges(state['page_token']):
+            for change in page.get('changes', []):
+                if change.get('changeType', 'file') == 'file':
+                    self.ApplyChange(state['folders'], change)
+                    num_changes += 1
+            page_token = page.get('newStartPageToken') or page['nextPageToken']
+            if page_token != state['page_token']:
+                state['page_token'] = page_token
+                self.dirty = True
+        return num_changes
+
+    def ApplyChange(self, folders, change):
+        file_id = change['fileId']
+        file = change.get('file')
+
+        if change.get('removed') or not file or file.get('trashed'):
+            self.RemoveFolder(file_id)
+            parents = []
+        else:
+            parents = [folder_id for folder_id in file.get('parents', []) if folder_id in folders]
+            file = {key: value for key, value in file.items() if key not in ['parents', 'trashed']}
+
+        for folder_id in self.locations.pop(file_id, set()):
+            entry = folders[folder_id]
+            entry['files'] = [metadata for metadata in entry['files'] if metadata['id'] != file_id]
+
+        for folder_id in parents:
+            files = folders[folder_id]['files']
+            files.append(file)
+            files.sort(key=GetListingKey)
+        if parents:
+            self.locations[file_id] = set(parents)
+        self.dirty = True
+
+    #endregion
+
+def GetListingKey(metadata):
+    # Sorts like LISTING_ORDER: folders first, then by name with digit runs compared as numbers
+    return (metadata['mimeType'] != DRIVE_FOLDER_MIME_TYPE, GetNaturalKey(metadata['name']))
+
+def GetNaturalKey(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name.casefold())]
@@ -0,0 +1,87 @@
+"""
+Local and network folder listings, read in one pass with os.scandir
+"""
+import os
+from datetime import datetime
+from kmexplorer.listing import GetNaturalKey
+
+SIZE_UNITS = ["B", "KB", "MB", "GB", "TB"]
+MODIFIED_FORMAT = "%Y-%m-%d %H:%M"
+FOLDER_TYPE = "Folder"
+
+class LocalEntry:
+    # One file or folder in a listing. On Windows the type, size and modified time all come back
+    # with the directory read itself, so a listing costs no stat call per entry even on an SMB share.
+    # Whether VLC can play the entry is decided once here instead of every time it is opened.
+    def __init__(self, name, path, is_dir, size=None, modified=None, playable=False):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.modified = modified
+        self.playable = playable
+
+    @classmethod
+    def FromDirEntry(cls, entry : os.DirEntry, is_playable):
+        is_dir = entry.is_dir()
+        try:
+            stat = entry.stat()
+            size, modified = (None if is_dir else stat.st_size), stat.st_mtime
+        except OSError:
+            # Broken links, and files removed since the directory was read, are listed without details
+            size, modified = None, None
+        return cls(entry.name, entry.path, is_dir, size, modified, not is_dir and is_playable(entry.name))
+
+    @classmethod
+    def FromPath(cls, path, is_playable):
+        # For a single path that didn't come from a listing, such as a finished download
+        path = str(path)
+        name = os.path.basename(path.rstrip('\\/')) or path
+        is_dir = os.path.isdir(path)
+        try:
+            stat = os.stat(path)
+            size, modified = (None if is_dir else stat.st_size), stat.st_mtime
+        except OSError:
+            size, modified = None, None
+        return cls(name, path, is_dir, size, modified, not is_dir and is_playable(name))
+
+    def GetType(self):
+        if self.is_dir:
+            return FOLDER_TYPE
+        _, extension = os.path.splitext(self.name)
+        return f"{extension[1:].upper()} File" if extension else "File"
+
+    def GetRow(self):
+        # Extra keys are kept on the table row, so opening it doesn't have to look at the disk again
+        return {
+            'name': self.name,
+            'size': FormatSize(self.size),
+            'modified': FormatModified(self.modified),
+            'type': self.GetType(),
+            'path': self.path,
+            'is_dir': self.is_dir,
+            'playable': self.playable
+        }
+
+    def GetSortKey(self):
+        return (not self.is_dir, GetNaturalKey(self.name))
+
+def ListLocalFolder(folder_path, is_playable):
+    # Every entry in folder_path, folders first and then by name with numbers in numeric order
+    with os.scandir(folder_path) as entries:
+        local_entries = [LocalEntry.FromDirEntry(entry, is_playable) for entry in entries]
+    return sorted(local_entries, key=LocalEntry.GetSortKey)
+
+def FormatSize(size):
+    if size is None:
+        return ''
+    unit = 0
+    while size >= 1024 and unit < len(SIZE_UNITS) - 1:
+        size /= 1024
+        unit += 1
+    return f"{size:0.0f} {SIZE_UNITS[unit]}" if unit == 0 else f"{size:0.1f} {SIZE_UNITS[unit]}"
+
+def FormatModified(modified):
+    if modified is None:
+        return ''
+    return datetime.fromtimestamp(modified).strftime(MODIFIED_FORMAT)
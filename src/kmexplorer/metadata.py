@@ -0,0 +1,114 @@
+"""
+Google Drive file metadata, looked up through batch requests and cached in memory
+"""
+import asyncio
+import aiohttp
+from time import monotonic
+from kmexplorer.drive import DriveRequestError
+from kmexplorer.client import DriveClient, DRIVE_FILE_FIELDS
+
+METADATA_BATCH_SIZE = 100
+METADATA_BATCH_DELAY = 0.01
+METADATA_CACHE_TTL = 300
+
+class DriveMetadata:
+    # Get() calls made within METADATA_BATCH_DELAY of each other are sent together as one Drive batch
+    # request of up to METADATA_BATCH_SIZE files.get calls, and answers are cached for METADATA_CACHE_TTL.
+    # Concurrent lookups of the same id share one request.
+    def __init__(self, client : DriveClient, fields=DRIVE_FILE_FIELDS, batch_size=METADATA_BATCH_SIZE, cache_ttl=METADATA_CACHE_TTL):
+        self.client = client
+        self.fields = fields
+        self.batch_size = batch_size
+        self.cache_ttl = cache_ttl
+        self.cache = {}
+        self.pending = {}
+        self.flush_handle = None
+
+    #region Cache
+
+    def GetCached(self, file_id):
+        entry = self.cache.get(file_id)
+        if entry is None:
+            return None
+        metadata, cached_time = entry
+        if monotonic() - cached_time > self.cache_ttl:
+            del self.cache[file_id]
+            return None
+        return metadata
+
+    def Add(self, metadata):
+        # Listings return the same fields, so they can fill the cache without any extra requests
+        self.cache[metadata['id']] = (metadata, monotonic())
+
+    def Invalidate(self, file_id=None):
+        if file_id is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(file_id, None)
+
+    #endregion
+
+    #region Lookups
+
+    async def Get(self, file_id):
+        metadata = self.GetCached(file_id)
+        if metadata is not None:
+            return metadata
+
+        future = self.pending.get(file_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[file_id] = future
+            self.ScheduleFlush()
+        return await asyncio.shield(future)
+
+    def ScheduleFlush(self):
+        loop = asyncio.get_running_loop()
+        if len(self.pending) >= self.batch_size:
+            if self.flush_handle:
+                self.flush_handle.cancel()
+            self.Flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(METADATA_BATCH_DELAY, self.Flush)
+
+    def Flush(self):
+        self.flush_handle = None
+        pending, self.pending = self.pending, {}
+
+        file_ids = list(pending)
+        for start in range(0, len(file_ids), self.batch_size):
+            batch = {file_id: pending[file_id] for file_id in file_ids[start:start + self.batch_size]}
+            asyncio.ensure_future(self.Resolve(batch))
+
+    async def Resolve(self, batch):
+        try:
+            if len(batch) == 1:
+                results = {file_id: await self.GetOne(file_id) for file_id in batch}
+            else:
+                results = await self.client.GetFiles(list(batch), self.fields)
+
+                # Files that failed inside the batch with a transient error are retried on their own
+                for file_id, result in list(results.items()):
+                    if isinstance(result, DriveRequestError) and (result.IsRetryable() or result.IsAuthError()):
+                        results[file_id] = await self.GetOne(file_id)
+
+        except Exception as err:
+            results = {file_id: err for file_id in batch}
+
+        for file_id, future in batch.items():
+            result = results.get(file_id, DriveRequestError(404, f"No batch response for \"{file_id}\""))
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                self.Add(result)
+                future.set_result(result)
+
+    async def GetOne(self, file_id):
+        try:
+            return await self.client.GetFile(file_id, self.fields)
+        except (DriveRequestError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+            return err
+
+    #endregion
@@ -0,0 +1,643 @@
+"""
+Loopback HTTP proxy that streams Google Drive media to VLC from a block cache
+"""
+import re
+import os
+import asyncio
+import aiohttp
+import aiofiles
+import threading
+from aiohttp import web
+from collections import OrderedDict
+from kmexplorer.download import DownloadWriter, ProgressAggregator, RangePlanner, RangeResponseError, ParseContentRange
+from kmexplorer.drive import DriveSession, DriveToken, DriveRequestError, RetryPolicy, GetDriveMediaURL
+from kmexplorer.engine import File, DownloadEngine
+from kmexplorer.limiter import BandwidthLimiter
+
+STREAM_HOST = "127.0.0.1"
+STREAM_BLOCK_SIZE = 2**21
+STREAM_PREFETCH_BLOCKS = 8
+STREAM_MAX_FETCHES = 6
+STREAM_CACHE_SIZE = 2**28
+STREAM_START_TIMEOUT = 10
+
+PROGRESSIVE_BLOCK_SIZE = 2**22
+PROGRESSIVE_HEAD_BLOCKS = 2
+PROGRESSIVE_TAIL_BLOCKS = 1
+PROGRESSIVE_MAX_RANGES = 8
+
+SPECULATIVE_DELAY = 0.3
+SPECULATIVE_HEAD_BYTES = PROGRESSIVE_HEAD_BLOCKS * PROGRESSIVE_BLOCK_SIZE
+SPECULATIVE_TAIL_EXTENSIONS = ['.mp4', '.m4v', '.mov', '.mkv', '.webm']
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+class BlockCache:
+    # Least recently used media blocks, keyed by (file_id, block index), capped at max_bytes
+    def __init__(self, max_bytes=STREAM_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.blocks = OrderedDict()
+
+    def Get(self, key):
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+        return block
+
+    def Contains(self, key):
+        return key in self.blocks
+
+    def Put(self, key, block):
+        if key in self.blocks:
+            self.num_bytes -= len(self.blocks.pop(key))
+        self.blocks[key] = block
+        self.num_bytes += len(block)
+
+        while self.num_bytes > self.max_bytes and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.num_bytes -= len(evicted)
+
+class StreamProxy:
+    # Serves http://127.0.0.1:<port>/<file_id> with Range support. Every request is answered
+    # from STREAM_BLOCK_SIZE blocks fetched ahead in parallel over one pooled Drive session.
+    # The proxy runs its own event loop on a daemon thread, since libvlc reads from it while
+    # the UI thread is blocked waiting for the media to open.
+    def __init__(self, token : DriveToken = None, api_key=None, block_size=STREAM_BLOCK_SIZE, prefetch_blocks=STREAM_PREFETCH_BLOCKS, max_fetches=STREAM_MAX_FETCHES, cache_size=STREAM_CACHE_SIZE, retry_policy=None, limiter : BandwidthLimiter = None):
+        self.token = token
+        self.api_key = api_key
+        self.block_size = block_size
+        self.prefetch_blocks = prefetch_blocks
+        self.max_fetches = max_fetches
+        self.cache = BlockCache(cache_size)
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.limiter = limiter
+        self.drive_session = DriveSession(limit_per_host=max_fetches)
+        self.sizes = {}
+        self.fetching = {}
+        self.progressive = {}
+        self.speculation = None
+        self.speculative = set()
+        self.loop = None
+        self.thread = None
+        self.runner = None
+        self.port = None
+
+    #region Server
+
+    def IsRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def Start(self):
+        if self.IsRunning():
+            return self.port
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="kmexplorer-stream", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.StartServer(), self.loop).result(STREAM_START_TIMEOUT)
+
+        print(f"DEBUG: Streaming proxy listening on {STREAM_HOST}:{self.port}")
+        return self.port
+
+    async def StartServer(self):
+        self.fetch_slots = asyncio.Semaphore(self.max_fetches)
+
+        server = web.Application()
+        server.router.add_route("GET", "/{file_id}", self.HandleRequest)
+        server.router.add_route("HEAD", "/{file_id}", self.HandleRequest)
+
+        self.runner = web.AppRunner(server, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, STREAM_HOST, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def Stop(self):
+        if not self.IsRunning():
+            return
+
+        print("DEBUG: Stopping streaming proxy")
+        try:
+            asyncio.run_coroutine_threadsafe(self.StopServer(), self.loop).result(STREAM_START_TIMEOUT)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(STREAM_START_TIMEOUT)
+            self.thread = None
+
+    async def StopServer(self):
+        if self.speculation:
+            self.speculation.cancel()
+        for task in self.fetching.values():
+            task.cancel()
+        for download in self.progressive.values():
+            download.Cancel()
+        await self.runner.cleanup()
+        await self.drive_session.Close()
+
+    def GetURL(self, file_id):
+        self.Start()
+        return f"http://{STREAM_HOST}:{self.port}/{file_id}"
+
+    def StartProgressive(self, file : File, download_path, progress : ProgressAggregator = None, on_error=None):
+        # Downloads file to download_path on the proxy's loop, and serves it from there while it fills in.
+        # Returns the download and a concurrent future for its result; on_error is called from the proxy thread.
+        self.Start()
+        download = ProgressiveDownload(
+            DownloadEngine(self.drive_session, self.token, self.api_key, self.retry_policy, on_error, limiter=self.limiter),
+            file,
+            download_path,
+            progress,
+            seed=lambda start_byte, end_byte: self.GetCachedRange(file.id, start_byte, end_byte)
+        )
+        return download, asyncio.run_coroutine_threadsafe(self.RunProgressive(download), self.loop)
+
+    async def RunProgressive(self, download):
+        # Only one download writes a file id at a time, so the previous one has to finish cancelling first
+        previous = self.progressive.pop(download.file.id, None)
+        if previous:
+            previous.Cancel()
+            await previous.finished.wait()
+
+        # Registered once it knows which blocks are missing, so the player never reads unwritten bytes.
+        # A verified download stays registered, so the player keeps reading the local file; any other
+        # outcome is dropped, and requests for the file go back to Drive.
+        success = False
+        try:
+            await download.Open()
+            self.progressive[download.file.id] = download
+            success = await download.Run()
+            return success
+        finally:
+            if not success and self.progressive.get(download.file.id) is download:
+                del self.progressive[download.file.id]
+
+    def WaitUntilBuffered(self, download):
+        return asyncio.run_coroutine_threadsafe(download.WaitUntilBuffered(), self.loop)
+
+    def CancelProgressive(self, download):
+        if self.IsRunning():
+            self.loop.call_soon_threadsafe(download.Cancel)
+
+    #endregion
+
+    #region Speculation
+
+    def Speculate(self, file_id, name):
+        # Called from the UI thread when a Drive file is highlighted
+        if self.token is None:
+            return
+        self.Start()
+        self.loop.call_soon_threadsafe(self.StartSpeculation, file_id, name)
+
+    def StartSpeculation(self, file_id, name):
+        # Only the highlighted file is speculated on; moving the selection cancels the fetches it started
+        if self.speculation:
+            self.speculation.cancel()
+        self.CancelSpeculativeFetches()
+        self.speculation = asyncio.ensure_future(self.RunSpeculation(file_id, name))
+
+    def CancelSpeculativeFetches(self):
+        # Fetches the player has asked for since are no longer speculative, and keep going
+        for key in self.speculative:
+            task = self.fetching.get(key)
+            if task:
+                task.cancel()
+        self.speculative.clear()
+
+    async def RunSpeculation(self, file_id, name):
+        # Fetches the blocks playback or a progressive download will start with: the head, and for MP4/MKV
+        # the tail that holds the moov atom or cues. The size request also opens the pooled connections.
+        # Waits SPECULATIVE_DELAY first, so scrolling through the table does not fetch every row.
+        await asyncio.sleep(SPECULATIVE_DELAY)
+        if file_id in self.progressive:
+            return
+
+        try:
+            size = await self.GetSize(file_id)
+            if size == 0:
+                return
+
+            ranges = [(0, min(size, SPECULATIVE_HEAD_BYTES))]
+            if os.path.splitext(name)[1].lower() in SPECULATIVE_TAIL_EXTENSIONS:
+                ranges.append((((size - 1) // PROGRESSIVE_BLOCK_SIZE) * PROGRESSIVE_BLOCK_SIZE, size))
+
+            tasks = []
+            for start_byte, end_byte in ranges:
+                for index in range(start_byte // self.block_size, (end_byte - 1) // self.block_size + 1):
+                    key = (file_id, index)
+                    if self.cache.Contains(key):
+                        continue
+                    if key not in self.fetching:
+                        self.StartFetch(file_id, size, index)
+                        self.speculative.add(key)
+                    tasks.append(self.fetching[key])
+            # Shielded, so cancelling the speculation never cancels a fetch the player is waiting on
+            await asyncio.gather(*map(asyncio.shield, tasks))
+            self.speculative.clear()
+            print(f"DEBUG: Speculatively fetched {len(tasks)} blocks of \"{name}\"")
+
+        except (DriveRequestError, aiohttp.ClientError, asyncio.TimeoutError, RangeResponseError) as err:
+            print(f"DEBUG: Unable to speculatively fetch \"{name}\": {err!r}")
+
+    def GetCachedRange(self, file_id, start_byte, end_byte):
+        # Returns the bytes from start_byte to end_byte if every block covering them is cached, otherwise None
+        blocks = []
+        for index in range(start_byte // self.block_size, (end_byte - 1) // self.block_size + 1):
+            block = self.cache.Get((file_id, index))
+            if block is None:
+                return None
+            blocks.append(block)
+
+        offset = start_byte - (start_byte // self.block_size) * self.block_size
+        data = b''.join(blocks)[offset:offset + end_byte - start_byte]
+        return data if len(data) == end_byte - start_byte else None
+
+    #endregion
+
+    #region Requests
+
+    async def HandleRequest(self, request : web.Request):
+        file_id = request.match_info["file_id"]
+
+        try:
+            size = await self.GetSize(file_id)
+        except (DriveRequestError, aiohttp.ClientError, asyncio.TimeoutError, RangeResponseError) as err:
+            print(f"ERROR: Unable to stream \"{file_id}\": {err!r}")
+            return web.Response(status=getattr(err, 'status', 502))
+
+        byte_range = self.ParseRange(request.headers.get("Range"), size)
+        if byte_range is None:
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+
+        start_byte, end_byte = byte_range
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(end_byte - start_byte)
+        }
+        if "Range" in request.headers:
+            headers["Content-Range"] = f"bytes {start_byte}-{end_byte - 1}/{size}"
+
+        response = web.StreamResponse(status=206 if "Range" in request.headers else 200, headers=headers)
+        await response.prepare(request)
+
+        if request.method == "HEAD":
+            return response
+
+        position = start_byte
+        try:
+            while position < end_byte:
+                data = await self.Read(file_id, size, position, end_byte)
+                await response.write(data)
+                position += len(data)
+
+        except ConnectionResetError:
+            # VLC drops the connection whenever it seeks
+            pass
+        except Exception as err:
+            print(f"ERROR: Stopped streaming \"{file_id}\" at byte {position}: {err!r}")
+
+        return response
+
+    def ParseRange(self, range_header, size):
+        if not range_header:
+            return (0, size)
+
+        match = RANGE_PATTERN.fullmatch(range_header.strip())
+        if not match or match.groups() == ('', ''):
+            return None
+
+        first, last = match.groups()
+        if first == '':
+            start_byte, end_byte = max(0, size - int(last)), size
+        else:
+            start_byte = int(first)
+            end_byte = min(size, int(last) + 1) if last else size
+
+        if start_byte >= end_byte:
+            return None
+        return (start_byte, end_byte)
+
+    #endregion
+
+    #region Blocks
+
+    async def Read(self, file_id, size, start_byte, end_byte):
+        # Returns the bytes from start_byte up to the end of its block (or end_byte)
+        if file_id in self.progressive:
+            return await self.progressive[file_id].Read(start_byte, end_byte)
+
+        index = start_byte // self.block_size
+        self.Prefetch(file_id, size, index + 1)
+
+        block = await self.GetBlock(file_id, size, index)
+        offset = start_byte - index * self.block_size
+        return block[offset:offset + end_byte - start_byte]
+
+    async def GetSize(self, file_id):
+        # The first block is fetched with the size request, so playback can start from it
+        if file_id in self.progressive:
+            return self.progressive[file_id].file.size
+        if file_id not in self.sizes:
+            await self.GetBlock(file_id, None, 0)
+        return self.sizes[file_id]
+
+    def GetBlockRange(self, size, index):
+        start_byte = index * self.block_size
+        return (start_byte, min(size, start_byte + self.block_size))
+
+    def Prefetch(self, file_id, size, first_index):
+        last_index = min(first_index + self.prefetch_blocks, (size - 1) // self.block_size + 1)
+        for index in range(first_index, last_index):
+            key = (file_id, index)
+            if not self.cache.Contains(key) and key not in self.fetching:
+                self.StartFetch(file_id, size, index)
+
+    def StartFetch(self, file_id, size, index):
+        key = (file_id, index)
+        task = asyncio.ensure_future(self.FetchBlock(file_id, size, index))
+        self.fetching[key] = task
+        task.add_done_callback(lambda _: self.fetching.pop(key, None))
+        return task
+
+    async def GetBlock(self, file_id, size, index):
+        key = (file_id, index)
+        block = self.cache.Get(key)
+        if block is not None:
+            return block
+
+        task = self.fetching.get(key)
+        if task is None:
+            task = self.StartFetch(file_id, size, index)
+        self.speculative.discard(key)
+        return await asyncio.shield(task)
+
+    async def FetchBlock(self, file_id, size, index):
+        attempt = 0
+
+        while True:
+            token = self.token.Get()
+            retry_after = None
+
+            try:
+                async with self.fetch_slots:
+                    block = await self.FetchRange(file_id, size, index)
+                self.cache.Put((file_id, index), block)
+                return block
+
+            except DriveRequestError as err:
+                if err.IsAuthError():
+                    if not await self.token.Refresh(token):
+                        raise
+                    reason = "access token expired"
+                elif err.IsRetryable():
+                    retry_after = err.retry_after
+                    reason = f"status {err.status}"
+                else:
+                    raise
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, RangeResponseError) as err:
+                reason = repr(err)
+
+            if attempt >= self.retry_policy.max_retries:
+                print(f"ERROR: Giving up on block {index} of \"{file_id}\" after {attempt + 1} attempts ({reason})")
+                raise RangeResponseError(f"Unable to fetch block {index} of \"{file_id}\" ({reason})")
+
+            delay = self.retry_policy.GetDelay(attempt, retry_after)
+            print(f"DEBUG: Retrying block {index} of \"{file_id}\" in {delay:0.1f}s ({reason})")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def FetchRange(self, file_id, size, index):
+        client = self.drive_session.GetSession()
+        headers = self.token.GetHeaders()
+
+        if size is None:
+            start_byte, end_byte = index * self.block_size, (index + 1) * self.block_size
+        else:
+            start_byte, end_byte = self.GetBlockRange(size, index)
+        headers["Range"] = RangePlanner(end_byte).GetRangeHeader(start_byte, end_byte)
+
+        async with client.get(GetDriveMediaURL(file_id, self.api_key), params={"supportsAllDrives": "true"}, headers=headers) as resp:
+            if resp.status not in [200, 206]:
+                raise DriveRequestError(resp.status, await resp.text(), resp.headers.get("Retry-After"))
+
+            if size is None:
+                size = self.GetResponseSize(resp)
+                end_byte = min(size, end_byte)
+                self.sizes[file_id] = size
+
+            RangePlanner(size).ValidateResponse(resp.status, resp.headers, start_byte, end_byte)
+            if not self.limiter:
+                return await resp.read()
+
+            chunks = []
+            async for chunk, _ in resp.content.iter_chunks():
+                await self.limiter.Acquire(len(chunk))
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+    def GetResponseSize(self, resp):
+        content_range = ParseContentRange(resp.headers.get("Content-Range"))
+        if content_range is None or content_range[2] is None:
+            raise RangeResponseError(f"Unable to determine the file size from Content-Range: {resp.headers.get('Content-Range')}")
+        return content_range[2]
+
+    #endregion
+
+class ProgressiveDownload:
+    # Downloads a file in PROGRESSIVE_BLOCK_SIZE blocks so it can be played before it finishes.
+    # The first blocks and the last block (where MP4 moov atoms and MKV cues usually live) come first,
+    # then whichever missing block is closest ahead of the position the player is reading.
+    # Blocks the player asks for are waited on, so it never reads the unwritten parts of the file.
+    # seed(start_byte, end_byte) may return head and tail bytes that were already fetched, which are written without a request.
+    def __init__(self, engine : DownloadEngine, file : File, download_path, progress : ProgressAggregator = None, block_size=PROGRESSIVE_BLOCK_SIZE, max_ranges=PROGRESSIVE_MAX_RANGES, seed=None):
+        self.engine = engine
+        self.file = file
+        self.download_path = download_path
+        self.progress = progress
+        self.block_size = block_size
+        self.max_ranges = max_ranges
+        self.seed = seed
+        self.writer = DownloadWriter(download_path, file.size, file.md5)
+        self.blocks = RangePlanner(file.size).CreateBlocks(block_size)
+        self.missing = set()
+        self.ready = {}
+        self.opened = False
+        self.position = 0
+        self.failed = False
+        self.buffered = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.reading = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def GetIndex(self, byte):
+        return byte // self.block_size
+
+    def GetBufferIndexes(self):
+        head = range(min(PROGRESSIVE_HEAD_BLOCKS, len(self.blocks)))
+        tail = range(max(0, len(self.blocks) - PROGRESSIVE_TAIL_BLOCKS), len(self.blocks))
+        return sorted(set(head) | set(tail))
+
+    def IsBlockReady(self, index):
+        return index not in self.missing and index not in self.ready
+
+    def SetPosition(self, index):
+        self.position = index
+
+    def GetNextBlock(self):
+        # Head and tail blocks first, then the nearest missing block at or after the play position, wrapping around
+        for index in self.GetBufferIndexes():
+            if index in self.missing:
+                return index
+        if not self.missing:
+            return None
+        return min(self.missing, key=lambda index: (index - self.position) % len(self.blocks))
+
+    async def Open(self):
+        missing_ranges = await self.writer.Open(self.file.id, self.blocks)
+        self.missing = {self.GetIndex(start_byte) for start_byte, _ in missing_ranges}
+        self.ready = {index: asyncio.Event() for index in self.missing}
+        self.opened = True
+
+    async def Run(self):
+        success = False
+        try:
+            if not self.opened:
+                await self.Open()
+            success = await self.Download()
+            return success
+        finally:
+            if not success:
+                self.failed = True
+            self.writer.Close()
+            self.Release()
+            self.finished.set()
+
+    async def Download(self):
+        if self.progress:
+            self.progress.AddCompleted(self.writer.GetBytesComplete())
+
+        await self.SeedBlocks()
+        self.CheckBuffered()
+        self.tasks = [asyncio.ensure_future(self.RunWorker()) for _ in range(min(self.max_ranges, len(self.missing)))]
+
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            self.failed = True
+            # The other workers are still unwinding; nothing may write to the file once the download has finished
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            self.Release()
+
+        if self.failed:
+            self.engine.ReportError(
+                "Download Failed",
+                f"Failed to download \"{self.file.name}\". Please try again later.\n\nDownloading to the same location again will resume where this download left off."
+            )
+            return False
+
+        await self.writer.Hash()
+
+        # The partial file can't be replaced while a read has it open, and nothing yields between this check and Finish
+        while self.reading:
+            await self.idle.wait()
+
+        if not self.writer.Finish():
+            self.engine.ReportError(
+                "Download Failed",
+                f"Unable to replace \"{self.download_path}\" with the finished download of \"{self.file.name}\". Please close any program using it and try again."
+            )
+            return False
+
+        if self.writer.Verify(self.file.id) == False:
+            self.engine.ReportError(
+                "Download Corrupt",
+                f"\"{self.file.name}\" did not match the checksum reported by Google Drive and may be corrupt.\n\nPlease download it again."
+            )
+            return False
+
+        print(f"\nFinished Downloading \"{self.file.name}\"!\n")
+        return True
+
+    async def RunWorker(self):
+        while not self.failed:
+            index = self.GetNextBlock()
+            if index is None:
+                return
+
+            self.missing.discard(index)
+            start_byte, end_byte = self.blocks[index]
+
+            if not await self.engine.DownloadPart(self.file, self.writer, self.progress, start_byte, end_byte):
+                self.failed = True
+                return
+
+            self.ready.pop(index).set()
+            self.CheckBuffered()
+
+    async def SeedBlocks(self):
+        if not self.seed:
+            return
+
+        for index in self.GetBufferIndexes():
+            if index not in self.missing:
+                continue
+            start_byte, end_byte = self.blocks[index]
+            data = self.seed(start_byte, end_byte)
+            if data is None:
+                continue
+
+            async with self.writer.OpenRange(start_byte, end_byte) as range_writer:
+                remaining = data[range_writer.bytes_written:]
+                await range_writer.Write(remaining)
+            if self.progress:
+                self.progress.AddCompleted(len(remaining))
+
+            print(f"DEBUG: Block {index} of \"{self.file.name}\" came from the stream cache")
+            self.missing.discard(index)
+            self.ready.pop(index).set()
+
+    def CheckBuffered(self):
+        if all(self.IsBlockReady(index) for index in self.GetBufferIndexes()):
+            self.buffered.set()
+
+    def Release(self):
+        # Wakes everything waiting on a block, so failed or cancelled downloads never hang the player
+        self.buffered.set()
+        for event in self.ready.values():
+            event.set()
+
+    def Cancel(self):
+        self.failed = True
+        for task in self.tasks:
+            task.cancel()
+
+    async def WaitUntilBuffered(self):
+        await self.buffered.wait()
+        return not self.failed
+
+    async def Read(self, start_byte, end_byte):
+        index = self.GetIndex(start_byte)
+        self.SetPosition(index)
+
+        if index in self.ready:
+            await self.ready[index].wait()
+        if not self.IsBlockReady(index):
+            raise RangeResponseError(f"Block {index} of \"{self.file.name}\" was not downloaded")
+
+        self.reading += 1
+        self.idle.clear()
+        try:
+            async with aiofiles.open(self.writer.GetPath(), "rb") as f:
+                await f.seek(start_byte)
+                return await f.read(min(end_byte, self.blocks[index][1]) - start_byte)
+        finally:
+            self.reading -= 1
+            if not self.reading:
+                self.idle.set()
@@ -0,0 +1,169 @@
+"""
+Incremental folder sync, so re-downloading a Drive folder only transfers what changed
+"""
+import os
+import json
+from time import monotonic
+from kmexplorer.download import VerifiedIndex, DownloadState
+from kmexplorer.engine import File, DownloadPathPlanner
+
+SYNC_STATE_NAME = ".kmexplorer-sync.json"
+SYNC_SAVE_INTERVAL = 1
+
+class SyncState:
+    # Per download folder record of every synced Drive file, keyed by file id:
+    # where it was saved, the Drive version it came from, and the size and mtime it had locally.
+    def __init__(self, download_folder):
+        self.download_folder = download_folder
+        self.path = os.path.join(download_folder, SYNC_STATE_NAME)
+        self.entries = None
+
+    def Load(self):
+        if self.entries is None:
+            try:
+                with open(self.path, "r", encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def Save(self):
+        os.makedirs(self.download_folder, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            json.dump(self.Load(), f)
+        os.replace(temp_path, self.path)
+
+    def Get(self, file_id):
+        return self.Load().get(file_id)
+
+    def GetLocalPath(self, entry):
+        return os.path.join(self.download_folder, entry['path'])
+
+    def Record(self, file : File, local_path):
+        self.Load()[file.id] = {
+            'path': os.path.relpath(local_path, self.download_folder),
+            'size': file.size,
+            'md5Checksum': file.md5,
+            'modifiedTime': file.modified,
+            'mtime': os.path.getmtime(local_path)
+        }
+
+    def Remove(self, file_id):
+        self.Load().pop(file_id, None)
+
+    def IsLocalUnchanged(self, entry):
+        # The local copy still has the size and mtime it was synced with
+        local_path = self.GetLocalPath(entry)
+        return os.path.isfile(local_path) \
+            and os.path.getsize(local_path) == entry['size'] \
+            and os.path.getmtime(local_path) == entry['mtime']
+
+    def IsCurrent(self, entry, file : File):
+        # Drive's md5Checksum decides when there is one; otherwise size and modifiedTime do
+        if entry['size'] != file.size:
+            return False
+        if file.md5:
+            return entry['md5Checksum'] == file.md5
+        return entry['modifiedTime'] == file.modified
+
+class FolderSync:
+    # Decides which listed files need transferring into download_folder. Unchanged files are skipped,
+    # files that were only renamed or moved on Drive are moved locally, and with delete_removed,
+    # synced files that are gone from Drive are deleted once the whole tree was listed.
+    # The state is saved as files finish (at most every SYNC_SAVE_INTERVAL seconds), so an
+    # interrupted folder download doesn't transfer its finished files again.
+    def __init__(self, download_folder, delete_removed=False):
+        self.download_folder = download_folder
+        self.delete_removed = delete_removed
+        self.state = SyncState(download_folder)
+        self.paths = DownloadPathPlanner(download_folder)
+        self.seen = set()
+        self.num_skipped = 0
+        self.num_moved = 0
+        self.failed_removals = {}
+        self.last_save = 0
+
+    def Save(self, force=False):
+        if not force and monotonic() - self.last_save < SYNC_SAVE_INTERVAL:
+            return
+        self.last_save = monotonic()
+        try:
+            self.state.Save()
+        except OSError as err:
+            print(f"ERROR: Unable to save the sync state \"{self.state.path}\": {err}")
+
+    def Plan(self, file : File, relative_dir):
+        # Returns the path to download file to, or None if the local copy is already current
+        self.seen.add(file.id)
+        entry = self.state.Get(file.id)
+        download_path = self.paths.GetPath(relative_dir, file.name)
+
+        if entry and self.state.IsCurrent(entry, file) and self.state.IsLocalUnchanged(entry):
+            old_path = self.state.GetLocalPath(entry)
+            moved = os.path.normcase(old_path) != os.path.normcase(download_path)
+            if moved:
+                if os.path.exists(download_path):
+                    return download_path
+                print(f"DEBUG: Moving \"{old_path}\" to \"{download_path}\" instead of downloading it again")
+                try:
+                    os.replace(old_path, download_path)
+                except OSError as err:
+                    # e.g. the old copy is open in another program
+                    print(f"ERROR: Unable to move \"{old_path}\", downloading it again instead: {err}")
+                    return download_path
+                self.num_moved += 1
+            self.state.Record(file, download_path)
+            self.num_skipped += 1
+            # A move is saved straight away, since the state is all that knows where the file went
+            self.Save(force=moved)
+            return None
+
+        if VerifiedIndex(download_path).IsVerified(file.id, file.md5):
+            # Downloaded and verified before syncing was used for this folder
+            self.state.Record(file, download_path)
+            self.num_skipped += 1
+            return None
+
+        return download_path
+
+    def OnFinish(self, item):
+        # Passed to the scheduler as on_finish
+        if item.state == DownloadState.DONE:
+            self.Record(item)
+            self.Save()
+
+    def Record(self, item):
+        try:
+            self.state.Record(item.file, item.download_path)
+        except OSError as err:
+            print(f"ERROR: Unable to record \"{item.download_path}\" as synced: {err}")
+
+    def Finish(self, items, listed):
+        # Records finished downloads; deleting only happens after a complete listing,
+        # otherwise files in folders that failed to list would look deleted.
+        # Files that can't be deleted stay in the state, so the next sync tries again.
+        for item in items:
+            if item.state == DownloadState.DONE:
+                self.Record(item)
+
+        removed = []
+        if self.delete_removed and listed:
+            for file_id, entry in list(self.state.Load().items()):
+                if file_id in self.seen:
+                    continue
+                local_path = self.state.GetLocalPath(entry)
+                if self.state.IsLocalUnchanged(entry):
+                    print(f"DEBUG: Removing \"{local_path}\", which was deleted from Drive")
+                    try:
+                        os.remove(local_path)
+                    except OSError as err:
+                        print(f"ERROR: Unable to remove \"{local_path}\": {err}")
+                        self.failed_removals[local_path] = err
+                        continue
+                    removed.append(local_path)
+                self.state.Remove(file_id)
+
+        self.Save(force=True)
+        print(f"DEBUG: Sync skipped {self.num_skipped} unchanged files ({self.num_moved} moved) and removed {len(removed)}")
+        return removed
@@ -0,0 +1,238 @@
+"""
+Per-transfer download metrics, exported as JSON lines or Prometheus text
+"""
+import os
+import json
+from enum import Enum
+from time import time, monotonic
+from collections import deque
+
+TELEMETRY_HISTORY = 1000
+# The JSON lines file is moved aside to <name>.1 (replacing the previous one) once it reaches this size
+TELEMETRY_MAX_BYTES = 10 * 2**20
+TELEMETRY_JSONL_NAME = "kmexplorer-telemetry.jsonl"
+TELEMETRY_PROMETHEUS_NAME = "kmexplorer-telemetry.prom"
+
+class TelemetryFormat(Enum):
+    JSONL = "jsonl"
+    PROMETHEUS = "prometheus"
+
+class RangeMetrics:
+    # One range request (one attempt): time to first byte, bytes received, and time spent
+    # waiting on the disk, which separates a slow link from a slow drive
+    def __init__(self, start_byte, end_byte, attempt):
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.attempt = attempt
+        self.start_time = monotonic()
+        self.ttfb = None
+        self.duration = None
+        self.bytes = 0
+        self.write_seconds = 0
+        self.status = None
+        self.error = None
+
+    def FirstByte(self, status):
+        self.status = status
+        self.ttfb = monotonic() - self.start_time
+
+    def Finish(self, error=None):
+        self.duration = monotonic() - self.start_time
+        self.error = error
+
+    def ToDict(self):
+        return {
+            'start': self.start_byte,
+            'end': self.end_byte,
+            'attempt': self.attempt,
+            'status': self.status,
+            'ttfb_seconds': Round(self.ttfb),
+            'duration_seconds': Round(self.duration),
+            'bytes': self.bytes,
+            'write_seconds': Round(self.write_seconds),
+            'mbps': Round(GetMbps(self.bytes, self.duration)),
+            'error': self.error
+        }
+
+class TransferMetrics:
+    def __init__(self, file):
+        self.file_id = file.id
+        self.name = file.name
+        self.size = file.size
+        self.started = time()
+        self.start_time = monotonic()
+        self.duration = None
+        self.ranges = []
+        self.retries = 0
+        self.throttled = 0
+        self.success = None
+        self.job = None
+
+    def StartRange(self, start_byte, end_byte, attempt=0):
+        range_metrics = RangeMetrics(start_byte, end_byte, attempt)
+        self.ranges.append(range_metrics)
+        return range_metrics
+
+    def AddRetry(self, rate_limited=False):
+        self.retries += 1
+        if rate_limited:
+            self.throttled += 1
+
+    def Finish(self, success):
+        self.duration = monotonic() - self.start_time
+        self.success = success
+
+    def GetBytes(self):
+        return sum(range_metrics.bytes for range_metrics in self.ranges)
+
+    def GetTTFBs(self):
+        return [range_metrics.ttfb for range_metrics in self.ranges if range_metrics.ttfb is not None]
+
+    def ToDict(self):
+        ttfbs = self.GetTTFBs()
+        return {
+            'type': 'transfer',
+            'time': round(self.started, 3),
+            'id': self.file_id,
+            'name': self.name,
+            'size': self.size,
+            'success': self.success,
+            'bytes': self.GetBytes(),
+            'duration_seconds': Round(self.duration),
+            'mbps': Round(GetMbps(self.GetBytes(), self.duration)),
+            'ttfb_seconds_mean': Round(sum(ttfbs) / len(ttfbs)) if ttfbs else None,
+            'ttfb_seconds_max': Round(max(ttfbs)) if ttfbs else None,
+            'write_seconds': Round(sum(range_metrics.write_seconds for range_metrics in self.ranges)),
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'ranges': [range_metrics.ToDict() for range_metrics in self.ranges]
+        }
+
+class TelemetryJob:
+    # The transfers of one folder download, exported together with a summary when it ends
+    def __init__(self, name):
+        self.name = name
+        self.started = time()
+        self.start_time = monotonic()
+        self.transfers = []
+
+    def GetSummary(self, success):
+        duration = monotonic() - self.start_time
+        num_bytes = sum(metrics.GetBytes() for metrics in self.transfers)
+        return {
+            'type': 'job',
+            'time': round(self.started, 3),
+            'name': self.name,
+            'success': success,
+            'files': len(self.transfers),
+            'failed': sum(1 for metrics in self.transfers if not metrics.success),
+            'bytes': num_bytes,
+            'duration_seconds': Round(duration),
+            'mbps': Round(GetMbps(num_bytes, duration)),
+            'retries': sum(metrics.retries for metrics in self.transfers),
+            'throttled': sum(metrics.throttled for metrics in self.transfers)
+        }
+
+class Telemetry:
+    # Keeps the last TELEMETRY_HISTORY transfers in memory. A transfer started with a job from BeginJob()
+    # is exported with that job's summary at EndJob(); any other transfer is exported when it finishes,
+    # so a single download running alongside a folder job never counts towards it.
+    # With no directory, nothing is written.
+    def __init__(self, directory=None, format=TelemetryFormat.JSONL, max_bytes=TELEMETRY_MAX_BYTES):
+        self.directory = directory
+        self.format = format
+        self.max_bytes = max_bytes
+        self.transfers = deque(maxlen=TELEMETRY_HISTORY)
+
+    def StartTransfer(self, file, job : TelemetryJob = None):
+        metrics = TransferMetrics(file)
+        metrics.job = job
+        self.transfers.append(metrics)
+        if job is not None:
+            job.transfers.append(metrics)
+        return metrics
+
+    def FinishTransfer(self, metrics : TransferMetrics, success):
+        metrics.Finish(success)
+        if metrics.job is None:
+            self.Export([metrics])
+
+    def BeginJob(self, name):
+        return TelemetryJob(name)
+
+    def EndJob(self, job : TelemetryJob, success=None):
+        summary = job.GetSummary(success)
+        self.Export(job.transfers, summary)
+        return summary
+
+    #region Export
+
+    def Export(self, transfers, summary=None):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.format == TelemetryFormat.PROMETHEUS:
+                self.WritePrometheus(os.path.join(self.directory, TELEMETRY_PROMETHEUS_NAME), transfers, summary)
+            else:
+                self.WriteJSONLines(os.path.join(self.directory, TELEMETRY_JSONL_NAME), transfers, summary)
+        except OSError as err:
+            print(f"DEBUG: Unable to write download telemetry: {err}")
+
+    def WriteJSONLines(self, path, transfers, summary=None):
+        if os.path.isfile(path) and os.path.getsize(path) >= self.max_bytes:
+            os.replace(path, path + ".1")
+        with open(path, "a", encoding='utf-8') as f:
+            for metrics in transfers:
+                f.write(json.dumps(metrics.ToDict()) + '\n')
+            if summary:
+                f.write(json.dumps(summary) + '\n')
+
+    def WritePrometheus(self, path, transfers, summary=None):
+        # Rewritten after every download or job, for node_exporter's textfile collector
+        lines = []
+        transfer_metrics = [
+            ('kmexplorer_transfer_bytes', "Bytes received for the download", lambda d: d['bytes']),
+            ('kmexplorer_transfer_duration_seconds', "Wall time of the download", lambda d: d['duration_seconds']),
+            ('kmexplorer_transfer_mbps', "Effective aggregate throughput of the download", lambda d: d['mbps']),
+            ('kmexplorer_transfer_ttfb_seconds_mean', "Mean time to first byte across range requests", lambda d: d['ttfb_seconds_mean']),
+            ('kmexplorer_transfer_ttfb_seconds_max', "Slowest time to first byte across range requests", lambda d: d['ttfb_seconds_max']),
+            ('kmexplorer_transfer_write_seconds', "Time spent waiting on disk writes, summed across ranges", lambda d: d['write_seconds']),
+            ('kmexplorer_transfer_ranges', "Range requests made, including retried attempts", lambda d: len(d['ranges'])),
+            ('kmexplorer_transfer_retries', "Range requests retried", lambda d: d['retries']),
+            ('kmexplorer_transfer_throttled', "Retries caused by Drive rate limiting", lambda d: d['throttled'])
+        ]
+
+        transfer_dicts = [metrics.ToDict() for metrics in transfers]
+        for name, help_text, get_value in transfer_metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for transfer in transfer_dicts:
+                value = get_value(transfer)
+                if value is not None:
+                    labels = FormatLabels(file_id=transfer['id'], file=transfer['name'], success=str(bool(transfer['success'])).lower())
+                    lines.append(f"{name}{{{labels}}} {value}")
+
+        if summary:
+            labels = FormatLabels(job=summary['name'])
+            for key in ['files', 'failed', 'bytes', 'duration_seconds', 'mbps', 'retries', 'throttled']:
+                lines += [f"# TYPE kmexplorer_job_{key} gauge", f"kmexplorer_job_{key}{{{labels}}} {summary[key]}"]
+
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+    #endregion
+
+def GetMbps(num_bytes, duration):
+    if not duration:
+        return None
+    return num_bytes * 8 / duration / 10**6
+
+def Round(value, digits=4):
+    return None if value is None else round(value, digits)
+
+def FormatLabels(**labels):
+    def Escape(value):
+        return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return ','.join(f'{key}="{Escape(value)}"' for key, value in labels.items())